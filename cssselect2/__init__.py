@@ -6,19 +6,50 @@ documents (HTML, XML, etc.) that can be read by ElementTree-like parsers
 
 """
 
+from collections import Counter
+from time import perf_counter
+
 from webencodings import ascii_lower
 
+from . import metrics
+from .budget import BudgetExceededError
+
 # Classes are imported here to expose them at the top level of the module
-from .compiler import compile_selector_list  # noqa
+from .compiler import compile_selector_list, split_whitespace
 from .parser import SelectorError  # noqa
-from .tree import ElementWrapper  # noqa
+from .tree import ElementWrapper, LxmlElementWrapper  # noqa
 
 VERSION = __version__ = '0.8.0'
 
 
 class Matcher:
-    """A CSS selectors storage that can match against HTML elements."""
-    def __init__(self):
+    """A CSS selectors storage that can match against HTML elements.
+
+    :param statistics:
+        An optional mapping of ``(kind, key)`` tuples to the number of elements
+        having this key in typical documents, as collected by
+        :meth:`update_statistics`. When given, selectors are stored under their
+        most selective key instead of the first of their ID, class, local name
+        and namespace.
+    :param in_html_document:
+        Whether the matched elements are in HTML documents. When given, tests
+        are specialized for this document type and the matcher must only be
+        used with elements of this document type.
+    :param profile:
+        Whether tests are instrumented to collect the data returned by
+        :meth:`hot_rules`. Profiling slows matching down, and has no cost when
+        disabled.
+    :param budget:
+        An optional :class:`budget.Budget` enforced each time a selector is
+        tested against an element.
+    :param disable_over_budget:
+        Whether selectors exceeding ``budget`` are disabled and added to
+        :attr:`disabled_selectors` instead of raising
+        :exc:`budget.BudgetExceededError`.
+
+    """
+    def __init__(self, statistics=None, in_html_document=None, profile=False,
+                 budget=None, disable_over_budget=False):
         self.id_selectors = {}
         self.class_selectors = {}
         self.lower_local_name_selectors = {}
@@ -26,6 +57,29 @@ class Matcher:
         self.lang_attr_selectors = []
         self.other_selectors = []
         self.order = 0
+        self.statistics = Counter(statistics or ())
+        self.in_html_document = in_html_document
+        self.profile = profile
+        # [candidates, matches, seconds] lists, by selector order
+        self.profiles = {}
+        self.budget = budget
+        self.disable_over_budget = disable_over_budget
+        # Selectors disabled for exceeding the budget, as dict keys for fast
+        # membership tests in disabling order
+        self._disabled_selectors = {}
+        self._selectors = []
+        self._required_keys_index = None
+        self._invalidation_index = None
+
+    @property
+    def disabled_selectors(self):
+        """Selectors disabled for exceeding the budget.
+
+        A :class:`tuple` of :class:`compiler.CompiledSelector` objects never
+        matching anymore, in the order they have been disabled.
+
+        """
+        return tuple(self._disabled_selectors)
 
     def add_selector(self, selector, payload):
         """Add a selector and its payload to the matcher.
@@ -46,22 +100,295 @@ class Matcher:
         if selector.never_matches:
             return
 
-        entry = (
-            selector.test, selector.specificity, self.order, selector.pseudo_element,
-            payload)
-        if selector.id is not None:
-            self.id_selectors.setdefault(selector.id, []).append(entry)
+        # Entries are lists, so that lazy tests can be replaced once compiled.
+        entry = [
+            None, selector.specificity, self.order, selector.pseudo_element,
+            payload]
+        entry[0] = self._test(selector, entry)
+        self._selectors.append((selector, entry))
+        self._required_keys_index = None
+        self._invalidation_index = None
+        self._add_entry(selector, entry)
+
+    def _test(self, selector, entry):
+        if self.budget is not None:
+            test = _limited(
+                selector, self.in_html_document, self.budget,
+                self._disabled_selectors if self.disable_over_budget else None)
+        elif selector.lazy:
+            # Don’t compile the test until the selector is a candidate.
+            test = self._lazy_test(selector, entry)
+        else:
+            test = self._compiled_test(selector)
+        if self.profile:
+            return _profiled(test, self.profiles.setdefault(entry[2], [0, 0, 0]))
+        return test
+
+    def _compiled_test(self, selector):
+        if self.in_html_document is None:
+            return selector.test
+        return selector.specialized_test(self.in_html_document)
+
+    def _lazy_test(self, selector, entry):
+        """Return a test compiling the selector’s test when first called.
+
+        The compiled test then replaces the returned one in ``entry``, shared
+        by the buckets of this matcher and of pruned matchers.
+
+        """
+        compiled_test = None
+
+        def lazy_test(element):
+            nonlocal compiled_test
+            if compiled_test is None:
+                compiled_test = self._compiled_test(selector)
+                if entry[0] is lazy_test:
+                    entry[0] = compiled_test
+            return compiled_test(element)
+        return lazy_test
+
+    def _add_entry(self, selector, entry):
+        kind, key = self.bucket(selector)
+        if kind == 'id':
+            self.id_selectors.setdefault(key, []).append(entry)
+        elif kind == 'class':
+            self.class_selectors.setdefault(key, []).append(entry)
+        elif kind == 'local_name':
+            self.lower_local_name_selectors.setdefault(key, []).append(entry)
+        elif kind == 'namespace':
+            self.namespace_selectors.setdefault(key, []).append(entry)
+        elif kind == 'lang_attr':
+            self.lang_attr_selectors.append(entry)
+        else:
+            self.other_selectors.append(entry)
+
+    def bucket(self, selector):
+        """Return the bucket where a selector is stored.
+
+        :param selector:
+            A :class:`compiler.CompiledSelector` object.
+        :returns:
+            A ``(kind, key)`` tuple. ``kind`` is one of ``'id'``, ``'class'``,
+            ``'local_name'``, ``'namespace'``, ``'lang_attr'`` or ``'other'``,
+            ``key`` is :obj:`None` for the last two kinds.
+
+        """
+        if self.statistics:
+            candidates = []
+            if selector.id is not None:
+                candidates.append(('id', selector.id))
+            candidates.extend(
+                ('class', name) for name in reversed(selector.class_names))
+            if selector.local_name is not None:
+                candidates.append(('local_name', selector.lower_local_name))
+            if selector.namespace is not None:
+                candidates.append(('namespace', selector.namespace))
+            if candidates:
+                # Keys missing from statistics are considered as rare, ties
+                # keep the default order.
+                return min(candidates, key=self.statistics.__getitem__)
+        elif selector.id is not None:
+            return 'id', selector.id
         elif selector.class_name is not None:
-            self.class_selectors.setdefault(selector.class_name, []).append(entry)
+            return 'class', selector.class_name
         elif selector.local_name is not None:
-            self.lower_local_name_selectors.setdefault(
-                selector.lower_local_name, []).append(entry)
+            return 'local_name', selector.lower_local_name
         elif selector.namespace is not None:
-            self.namespace_selectors.setdefault(selector.namespace, []).append(entry)
-        elif selector.requires_lang_attr:
-            self.lang_attr_selectors.append(entry)
+            return 'namespace', selector.namespace
+        if selector.requires_lang_attr:
+            return 'lang_attr', None
+        return 'other', None
+
+    def __getstate__(self):
+        # Compiled tests can’t be pickled, they are taken again from the
+        # selectors and the buckets are rebuilt when unpickling.
+        state = self.__dict__.copy()
+        state['_selectors'] = [
+            (selector, entry[1:]) for selector, entry in self._selectors]
+        for name in (
+                'id_selectors', 'class_selectors', 'lower_local_name_selectors',
+                'namespace_selectors', 'lang_attr_selectors', 'other_selectors',
+                '_required_keys_index', '_invalidation_index'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        selectors = state.pop('_selectors')
+        self.__dict__.update(state)
+        self._selectors = []
+        for selector, entry in selectors:
+            entry = [None, *entry]
+            entry[0] = self._test(selector, entry)
+            self._selectors.append((selector, entry))
+        self.reindex()
+
+    def update_statistics(self, element):
+        """Count the keys found in the given element and its descendants.
+
+        Counts are added to :attr:`statistics`. Selectors already added are
+        not moved until :meth:`reindex` is called.
+
+        :param element:
+            An :class:`ElementWrapper`, usually the root of a sample document.
+
+        """
+        for element in element.iter_subtree():
+            self.statistics.update(_iter_keys(element))
+
+    def reindex(self):
+        """Store again all the selectors according to current statistics."""
+        self.id_selectors = {}
+        self.class_selectors = {}
+        self.lower_local_name_selectors = {}
+        self.namespace_selectors = {}
+        self.lang_attr_selectors = []
+        self.other_selectors = []
+        self._required_keys_index = None
+        self._invalidation_index = None
+        for selector, entry in self._selectors:
+            self._add_entry(selector, entry)
+
+    def pruned(self, vocabulary):
+        """Return a new matcher without the selectors that can’t match.
+
+        Selectors requiring an ID, a class, a local name, a namespace or an
+        attribute name missing from the vocabulary are dropped.
+
+        :param vocabulary:
+            A set of ``(kind, key)`` tuples, as returned by
+            :func:`vocabulary` for the document to match.
+        :returns:
+            A new :class:`Matcher` sharing its statistics with this one.
+
+        """
+        if self._required_keys_index is None:
+            # Index selectors by one of their required keys, so that only the
+            # selectors whose key is in the vocabulary have to be checked.
+            self._required_keys_index = index = {}
+            for selector, entry in self._selectors:
+                key = min(
+                    selector.required_keys, key=self.statistics.__getitem__,
+                    default=None)
+                index.setdefault(key, []).append((selector, entry))
+        index = self._required_keys_index
+
+        candidates = list(index.get(None, ()))
+        for key in vocabulary:
+            if key in index:
+                candidates.extend(index[key])
+        candidates.sort(key=lambda candidate: candidate[1][2])
+
+        matcher = type(self)(
+            in_html_document=self.in_html_document, profile=self.profile,
+            budget=self.budget, disable_over_budget=self.disable_over_budget)
+        matcher.statistics = self.statistics
+        matcher.profiles = self.profiles
+        matcher._disabled_selectors = self._disabled_selectors
+        matcher.order = self.order
+        for selector, entry in candidates:
+            if selector.required_keys <= vocabulary:
+                matcher._selectors.append((selector, entry))
+                matcher._add_entry(selector, entry)
+        return matcher
+
+    def invalidated(self, element, attribute, old_value=None, new_value=None):
+        """Return the elements whose matches may change after a mutation.
+
+        Only these elements have to be matched again after an attribute or the
+        tag of an element has been changed in place. Data cached for the
+        element and its document is cleared with
+        :meth:`ElementWrapper.invalidate`, other elements have to be wrapped
+        again, for example by iterating from the root.
+
+        :param element:
+            An :class:`ElementWrapper` for the changed element.
+        :param attribute:
+            The name of the changed attribute, or :obj:`None` when the tag of
+            the element changed.
+        :param old_value:
+            The previous value of the attribute or tag, :obj:`None` for a new
+            attribute or element.
+        :param new_value:
+            The new value of the attribute or tag, :obj:`None` for a removed
+            attribute or element.
+        :returns:
+            A list of new :class:`ElementWrapper` objects in tree order. The
+            included elements depend on the selectors using the changed
+            attribute or tag: the element itself, its descendants, its
+            following siblings and their descendants, or all the elements of
+            the document for selectors such as ``:has()`` or
+            ``:nth-child(… of …)``.
+
+        """
+        element.invalidate(attribute)
+        if self._invalidation_index is None:
+            # Index selectors orders and scopes by the keys they depend on.
+            self._invalidation_index = index = {}
+            for selector, entry in self._selectors:
+                for key, scope in selector.dependencies:
+                    index.setdefault(key, []).append((entry[2], scope))
+        index = self._invalidation_index
+
+        keys = set()
+        if attribute is None:
+            keys.add(('local_name', None))
+            for tag in (old_value, new_value):
+                if tag is not None:
+                    keys.add(('local_name', ascii_lower(tag.rpartition('}')[2])))
         else:
-            self.other_selectors.append(entry)
+            name = ascii_lower(attribute)
+            keys.add(('attribute', name))
+            keys.add(('attribute', name.rpartition('}')[2]))
+            if name == 'class':
+                old_classes = set(split_whitespace(old_value or ''))
+                new_classes = set(split_whitespace(new_value or ''))
+                keys.update(
+                    ('class', class_name)
+                    for class_name in old_classes ^ new_classes)
+            elif name == 'id':
+                keys.update(('id', value) for value in (old_value, new_value))
+        scopes = {scope for key in keys for _, scope in index.get(key, ())}
+
+        if 'document' in scopes:
+            while element.parent is not None:
+                element = element.parent
+            return list(element.iter_subtree())
+        elements = []
+        if 'descendants' in scopes:
+            elements.extend(element.iter_subtree())
+            if 'self' not in scopes:
+                del elements[0]
+        elif 'self' in scopes:
+            elements.append(element)
+        if 'sibling_subtrees' in scopes:
+            for sibling in element.iter_next_siblings():
+                elements.extend(sibling.iter_subtree())
+        elif 'siblings' in scopes:
+            elements.extend(element.iter_next_siblings())
+        return elements
+
+    def hot_rules(self, limit=None):
+        """Return profiling data of the selectors, most expensive first.
+
+        Data is only collected when the matcher is created with ``profile``.
+
+        :param limit:
+            The maximum number of returned selectors, or :obj:`None`.
+        :returns:
+            A list of ``(selector, bucket, candidates, matches, seconds)``
+            tuples, sorted by decreasing cumulative test time. ``selector`` is
+            the serialized selector, ``bucket`` is given by :meth:`bucket`,
+            ``candidates`` is the number of elements tested, ``matches`` the
+            number of tests that passed and ``seconds`` the time spent in
+            tests.
+
+        """
+        rules = [
+            (repr(selector.parsed_selector), self.bucket(selector),
+             *self.profiles[entry[2]])
+            for selector, entry in self._selectors if entry[2] in self.profiles]
+        rules.sort(key=lambda rule: rule[4], reverse=True)
+        return rules[:limit]
 
     def match(self, element):
         """Match selectors against the given element.
@@ -76,32 +403,33 @@ class Matcher:
             specificity.
 
         """
-        relevant_selectors = []
-
+        buckets = []
         if element.id is not None and element.id in self.id_selectors:
-            self.add_relevant_selectors(
-                element, self.id_selectors[element.id], relevant_selectors)
+            buckets.append(('id', self.id_selectors[element.id]))
 
         for class_name in element.classes:
             if class_name in self.class_selectors:
-                self.add_relevant_selectors(
-                    element, self.class_selectors[class_name], relevant_selectors)
+                buckets.append(('class', self.class_selectors[class_name]))
 
         lower_name = ascii_lower(element.local_name)
         if lower_name in self.lower_local_name_selectors:
-            self.add_relevant_selectors(
-                element, self.lower_local_name_selectors[lower_name],
-                relevant_selectors)
+            buckets.append(
+                ('local_name', self.lower_local_name_selectors[lower_name]))
         if element.namespace_url in self.namespace_selectors:
-            self.add_relevant_selectors(
-                element, self.namespace_selectors[element.namespace_url],
-                relevant_selectors)
+            buckets.append(
+                ('namespace', self.namespace_selectors[element.namespace_url]))
 
         if 'lang' in element.etree_element.attrib:
-            self.add_relevant_selectors(
-                element, self.lang_attr_selectors, relevant_selectors)
+            buckets.append(('lang_attr', self.lang_attr_selectors))
 
-        self.add_relevant_selectors(element, self.other_selectors, relevant_selectors)
+        buckets.append(('other', self.other_selectors))
+
+        relevant_selectors = []
+        for _, selectors in buckets:
+            self.add_relevant_selectors(element, selectors, relevant_selectors)
+        if metrics.installed:
+            for kind, selectors in buckets:
+                metrics.count(f'tests.{kind}', len(selectors))
 
         relevant_selectors.sort()
         return relevant_selectors
@@ -111,3 +439,98 @@ class Matcher:
         for test, specificity, order, pseudo, payload in selectors:
             if test(element):
                 relevant_selectors.append((specificity, order, pseudo, payload))
+
+
+def _profiled(test, profile):
+    """Return a test updating a ``[candidates, matches, seconds]`` list."""
+    def profiled_test(element):
+        start = perf_counter()
+        result = test(element)
+        profile[2] += perf_counter() - start
+        profile[0] += 1
+        if result:
+            profile[1] += 1
+        return result
+    return profiled_test
+
+
+def _limited(selector, in_html_document, budget, disabled_selectors):
+    """Return a test enforcing a budget, disabling the selector if needed."""
+    def limited_test(element):
+        if disabled_selectors is not None and selector in disabled_selectors:
+            return False
+        # Don’t compile the test until the selector is a candidate.
+        test = selector.budgeted_test(in_html_document)
+        try:
+            with budget:
+                return test(element)
+        except BudgetExceededError:
+            if disabled_selectors is None:
+                raise
+            disabled_selectors[selector] = None
+            return False
+    return limited_test
+
+
+def explain(selector, namespaces=None, matcher=None):
+    """Describe how selectors are compiled and matched.
+
+    :param selector:
+        Either a :class:`compiler.CompiledSelector`, or an argument to
+        :func:`compile_selector_list`.
+    :param namespaces:
+        A dictionary of all `namespace prefix declarations
+        <https://www.w3.org/TR/selectors/#nsdecl>`_ in scope for strings.
+    :param matcher:
+        The :class:`Matcher` whose statistics are used to choose buckets.
+    :returns:
+        A list of dictionaries, one for each selector, with the serialized
+        ``selector``, its ``parsed_tree``, the ``source`` of its test, its
+        ``bucket`` as returned by :meth:`Matcher.bucket`, its ``specificity``,
+        its ``pseudo_element``, and its ``cost`` and ``cost_factors`` as
+        given by :class:`compiler.CompiledSelector`.
+
+    """
+    if hasattr(selector, 'parsed_selector'):
+        selectors = [selector]
+    else:
+        selectors = compile_selector_list(selector, namespaces, lazy=True)
+    matcher = Matcher() if matcher is None else matcher
+    return [{
+        'selector': repr(selector.parsed_selector),
+        'parsed_tree': selector.parsed_selector.parsed_tree,
+        'source': selector.source,
+        'bucket': matcher.bucket(selector),
+        'specificity': selector.specificity,
+        'pseudo_element': selector.pseudo_element,
+        'cost': selector.cost,
+        'cost_factors': selector.cost_factors,
+    } for selector in selectors]
+
+
+def vocabulary(element):
+    """Return the keys found in an element and its descendants.
+
+    :param element:
+        An :class:`ElementWrapper`, usually the root of a document.
+    :returns:
+        A :class:`frozenset` of ``(kind, key)`` tuples, for the IDs, classes,
+        lowercase local names, namespaces and lowercase attribute names of the
+        elements.
+
+    """
+    return frozenset(
+        key for element in element.iter_subtree()
+        for key in _iter_keys(element))
+
+
+def _iter_keys(element):
+    """Yield the ``(kind, key)`` tuples describing the given element."""
+    if element.id is not None:
+        yield 'id', element.id
+    for class_name in element.classes:
+        yield 'class', class_name
+    yield 'local_name', ascii_lower(element.local_name)
+    yield 'namespace', element.namespace_url
+    for name in element.etree_element.attrib:
+        yield 'attribute', ascii_lower(name)
@@ -0,0 +1,75 @@
+"""Match selectors without blocking asyncio event loops."""
+
+import asyncio
+from time import perf_counter
+
+
+async def query_all(element, *selectors, batch_size=1000, time_slice=None):
+    """Asynchronous version of :meth:`ElementWrapper.query_all`.
+
+    Control is given back to the event loop after each ``batch_size`` visited
+    elements, and after each ``time_slice`` seconds if given, so that other
+    tasks can run during long queries.
+
+    :param element:
+        The :class:`ElementWrapper` whose subtree is queried.
+    :param selectors:
+        Each given selector is either a :class:`compiler.CompiledSelector`,
+        or an argument to :func:`compile_selector_list`.
+    :param batch_size:
+        The maximum number of elements visited without giving control back,
+        or :obj:`None`.
+    :param time_slice:
+        The maximum number of seconds spent without giving control back, or
+        :obj:`None`.
+    :returns:
+        An asynchronous iterator of newly-created :class:`ElementWrapper`
+        objects, in tree order.
+
+    """
+    tests = element._compile(selectors)
+    if not tests:
+        return
+    elements = _iter_cooperatively(element.iter_subtree(), batch_size, time_slice)
+    async for element in elements:
+        if any(test(element) for test in tests):
+            yield element
+
+
+async def match(matcher, element, batch_size=1000, time_slice=None):
+    """Match selectors against an element and its descendants.
+
+    Control is given back to the event loop as in :func:`query_all`.
+
+    :param matcher:
+        A :class:`Matcher`.
+    :param element:
+        An :class:`ElementWrapper`, usually the root of a document.
+    :param batch_size:
+        The maximum number of elements matched without giving control back,
+        or :obj:`None`.
+    :param time_slice:
+        The maximum number of seconds spent without giving control back, or
+        :obj:`None`.
+    :returns:
+        An asynchronous iterator of ``(element, matches)`` tuples for all the
+        elements of the subtree rooted at ``element``, in tree order, where
+        ``matches`` is the list returned by :meth:`Matcher.match`.
+
+    """
+    elements = _iter_cooperatively(element.iter_subtree(), batch_size, time_slice)
+    async for element in elements:
+        yield element, matcher.match(element)
+
+
+async def _iter_cooperatively(iterable, batch_size, time_slice):
+    count = 0
+    start = perf_counter()
+    for item in iterable:
+        yield item
+        count += 1
+        if (batch_size is not None and count >= batch_size) or (
+                time_slice is not None and perf_counter() - start >= time_slice):
+            await asyncio.sleep(0)
+            count = 0
+            start = perf_counter()
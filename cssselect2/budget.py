@@ -0,0 +1,151 @@
+"""Limit the work done to match selectors.
+
+Budgets protect from selectors whose tests are very long to run, such as
+selectors with many descendant combinators or nested ``:has()``. They are
+only enforced in a :class:`Budget` context, and cost a single check when no
+context is active::
+
+    with Budget(steps=100_000, seconds=0.1):
+        elements = list(root.query_all(untrusted_selector))
+
+"""
+
+from contextvars import ContextVar
+from time import perf_counter
+
+# Usages of the budgets enforced in the current context, innermost last
+_current = ContextVar('budgets', default=())
+
+
+class BudgetExceededError(Exception):
+    """Exception raised when the limit of a :class:`Budget` is exceeded."""
+    def __init__(self, budget, limit):
+        #: The exceeded :class:`Budget`.
+        self.budget = budget
+        #: The name of the exceeded limit, ``'steps'``, ``'elements'`` or
+        #: ``'seconds'``.
+        self.limit = limit
+        super().__init__(
+            f'Budget of {getattr(budget, limit)} {limit} exceeded')
+
+
+class Budget:
+    """Context manager limiting the work done to match selectors.
+
+    Limits are enforced in the current thread or asynchronous task while the
+    context is active, the work done in other threads or tasks is counted
+    separately. Nested contexts are enforced together with the enclosing
+    ones, and entering a context again resets its usage, unless it is already
+    active: the work is then counted once, in the enclosing context.
+
+    Limits are only enforced when matching elements with
+    :meth:`ElementWrapper.matches`, :meth:`ElementWrapper.query_all`,
+    :meth:`ElementWrapper.query` and :meth:`ElementWrapper.count`, or with a
+    :class:`Matcher` created with a budget. Iterators returned by
+    :meth:`ElementWrapper.query_all` run tests lazily, they have to be
+    consumed in the context.
+
+    :param steps:
+        The maximum number of steps, counted for each test and for each
+        element visited by the loops of tests, or :obj:`None`.
+    :param elements:
+        The maximum number of elements, counted for each element visited by
+        queries and by the loops of tests, or :obj:`None`.
+    :param seconds:
+        The maximum time spent in the context, or :obj:`None`.
+
+    """
+    def __init__(self, steps=None, elements=None, seconds=None):
+        self.steps = steps
+        self.elements = elements
+        self.seconds = seconds
+        self._last_usage = _Usage(self)
+
+    def __enter__(self):
+        usage = self._usage()
+        if usage is not None:
+            # Already active in this context, count the work only once.
+            usage.depth += 1
+        else:
+            usage = self._last_usage = _Usage(self)
+            usage.token = _current.set((*_current.get(), usage))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        usage = self._usage()
+        if usage.depth:
+            usage.depth -= 1
+        else:
+            _current.reset(usage.token)
+            usage.token = None
+
+    @property
+    def used_steps(self):
+        """The number of steps counted since the context was entered."""
+        return (self._usage() or self._last_usage).steps
+
+    @property
+    def used_elements(self):
+        """The number of elements visited since the context was entered."""
+        return (self._usage() or self._last_usage).elements
+
+    def _usage(self):
+        """Return the usage of this budget in the current context, or None."""
+        for usage in _current.get():
+            if usage.budget is self:
+                return usage
+
+
+class _Usage:
+    """Work counted for a :class:`Budget` in a context."""
+    def __init__(self, budget):
+        self.budget = budget
+        self.steps = self.elements = self.depth = 0
+        self.deadline = (
+            None if budget.seconds is None else perf_counter() + budget.seconds)
+        self.token = None
+
+    def step(self):
+        self.steps += 1
+        if self.budget.steps is not None and self.steps > self.budget.steps:
+            raise BudgetExceededError(self.budget, 'steps')
+        self.check_time()
+
+    def visit(self):
+        self.elements += 1
+        if (self.budget.elements is not None and
+                self.elements > self.budget.elements):
+            raise BudgetExceededError(self.budget, 'elements')
+        self.check_time()
+
+    def check_time(self):
+        if self.deadline is not None and perf_counter() > self.deadline:
+            raise BudgetExceededError(self.budget, 'seconds')
+
+
+def active():
+    """Return whether a budget is enforced in the current context."""
+    return bool(_current.get())
+
+
+def step():
+    """Count a step in the current budgets, if any. Always return True."""
+    for usage in _current.get():
+        usage.step()
+    return True
+
+
+def steps(iterable):
+    """Iterate over ``iterable``, counting a step for each item."""
+    for item in iterable:
+        for usage in _current.get():
+            usage.step()
+        yield item
+
+
+def visits(elements):
+    """Iterate over ``elements``, counting a visit for each element."""
+    for element in elements:
+        for usage in _current.get():
+            usage.visit()
+        yield element
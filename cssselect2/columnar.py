@@ -0,0 +1,453 @@
+"""Match selectors against whole documents stored as NumPy arrays.
+
+Documents are stored as columns of integers, one row per element in tree
+order, and selectors are evaluated as boolean masks over all the elements at
+once, with no Python call per element. This is useful to count or select
+elements in huge documents with many selectors.
+
+This module requires NumPy, installed with the ``columnar`` extra of
+cssselect2.
+
+"""
+
+import numpy as np
+from tinycss2.nth import parse_nth
+
+from . import parser
+from .compiler import split_whitespace
+from .parser import SelectorError
+from .tree import _split_etree_tag
+
+
+class ColumnarDocument:
+    """ElementTree document stored as NumPy arrays.
+
+    Elements are numbered in tree order, the root being ``0``. Comments and
+    processing instructions are ignored.
+
+    :param root:
+        An ElementTree :class:`xml.etree.ElementTree.Element` or
+        :class:`xml.etree.ElementTree.ElementTree`.
+    :param in_html_document:
+        Whether the document is an HTML document.
+
+    """
+    def __init__(self, root, in_html_document=False):
+        if hasattr(root, 'getroot'):
+            root = root.getroot()
+        self.in_html_document = in_html_document
+
+        #: The list of ElementTree elements, in tree order.
+        self.etree_elements = []
+        parents, depths, tags, texts, ends = [], [], [], [], []
+        self._tag_ids, self._local_name_ids, self._namespace_ids = {}, {}, {}
+        classes, attributes = {}, {}
+        stack = [(root, -1, 0)]
+        # Elements whose subtree end hasn’t been found yet
+        open_elements = []
+        while stack:
+            etree_element, parent, depth = stack.pop()
+            index = len(self.etree_elements)
+            while open_elements and depths[open_elements[-1]] >= depth:
+                ends[open_elements.pop()] = index
+            open_elements.append(index)
+            ends.append(None)
+            self.etree_elements.append(etree_element)
+            parents.append(parent)
+            depths.append(depth)
+            tags.append(self._tag_ids.setdefault(
+                etree_element.tag, len(self._tag_ids)))
+            texts.append(bool(etree_element.text))
+            for name, value in etree_element.attrib.items():
+                indexes, codes, value_ids = attributes.setdefault(
+                    name, ([], [], {}))
+                indexes.append(index)
+                codes.append(value_ids.setdefault(value, len(value_ids)))
+            for class_name in split_whitespace(etree_element.get('class', '')):
+                classes.setdefault(class_name, []).append(index)
+            stack.extend(
+                (child, index, depth + 1) for child in reversed(etree_element)
+                if isinstance(child.tag, str))
+        length = len(self.etree_elements)
+        for index in open_elements:
+            ends[index] = length
+
+        #: Tag ids, equal for elements with the same ElementTree tag.
+        self.tags = np.array(tags, dtype=np.intp)
+        #: Parent indexes, ``-1`` for the root.
+        self.parents = np.array(parents, dtype=np.intp)
+        #: Depths, ``0`` for the root.
+        self.depths = np.array(depths, dtype=np.intp)
+        self._texts = np.array(texts, dtype=bool)
+
+        # Local names and namespaces, by tag id
+        local_names, namespaces = [], []
+        for tag in self._tag_ids:
+            namespace, local_name = _split_etree_tag(tag)
+            local_names.append(
+                self._local_name_ids.setdefault(local_name, len(local_names)))
+            namespaces.append(
+                self._namespace_ids.setdefault(namespace, len(namespaces)))
+        self._local_names = np.array(local_names, dtype=np.intp)[self.tags]
+        self._namespaces = np.array(namespaces, dtype=np.intp)[self.tags]
+
+        #: Subtree ends, indexes following the last descendants.
+        self.ends = np.array(ends, dtype=np.intp)
+
+        elements = np.arange(length)
+        #: Positions among siblings.
+        self.positions, self._sibling_counts = _group_positions(
+            elements, self.parents)
+        #: Previous sibling indexes, ``-1`` for first children.
+        self.previous = np.full(length, -1, dtype=np.intp)
+        order = np.lexsort((elements, self.parents))
+        same_parent = self.parents[order[1:]] == self.parents[order[:-1]]
+        self.previous[order[1:][same_parent]] = order[:-1][same_parent]
+
+        self._classes = {
+            class_name: np.array(indexes, dtype=np.intp)
+            for class_name, indexes in classes.items()}
+        # Attribute values are stored as codes, indexes of distinct values.
+        self._attributes = {
+            name: (
+                np.array(indexes, dtype=np.intp),
+                np.array(codes, dtype=np.intp), value_ids)
+            for name, (indexes, codes, value_ids) in attributes.items()}
+        self._masks = {}
+
+    def __len__(self):
+        return len(self.etree_elements)
+
+    def mask(self, *selectors):
+        """Return a mask of the elements matching any of given selectors.
+
+        :param selectors:
+            Each given selector is either a :class:`compiler.CompiledSelector`,
+            or an argument to :func:`compile_selector_list`.
+        :returns:
+            A boolean NumPy array, with one item per element in tree order.
+        :raises:
+            :class:`SelectorError` if a selector can’t be evaluated on arrays,
+            for example when it includes ``:lang()`` or ``:enabled``.
+
+        """
+        result = self._zeros()
+        for selector in selectors:
+            # Only parse selectors, their tests are not needed.
+            for parsed_selector in (
+                    [selector.parsed_selector]
+                    if hasattr(selector, 'parsed_selector')
+                    else parser.parse(selector)):
+                if parsed_selector.pseudo_element is None:
+                    result |= self._mask(parsed_selector.parsed_tree)
+        return result
+
+    def query_all(self, *selectors):
+        """Return ElementTree elements matching any of given selectors.
+
+        :param selectors:
+            Each given selector is either a :class:`compiler.CompiledSelector`,
+            or an argument to :func:`compile_selector_list`.
+        :returns:
+            A list of :class:`xml.etree.ElementTree.Element` objects,
+            in tree order.
+
+        """
+        return [
+            self.etree_elements[index]
+            for index in np.flatnonzero(self.mask(*selectors))]
+
+    def count(self, *selectors):
+        """Return the number of elements matching any of given selectors.
+
+        :param selectors:
+            Each given selector is either a :class:`compiler.CompiledSelector`,
+            or an argument to :func:`compile_selector_list`.
+
+        """
+        return int(np.count_nonzero(self.mask(*selectors)))
+
+    def _zeros(self):
+        return np.zeros(len(self), dtype=bool)
+
+    def _from_indexes(self, indexes):
+        mask = self._zeros()
+        mask[indexes] = True
+        return mask
+
+    def _related(self, mask, related):
+        """Return a mask of elements whose related element is in ``mask``.
+
+        ``related`` is an array of element indexes, ``-1`` meaning no element.
+
+        """
+        exists = related >= 0
+        result = self._zeros()
+        result[exists] = mask[related[exists]]
+        return result
+
+    def _mask(self, selector):
+        if isinstance(selector, parser.CombinedSelector):
+            left = self._mask(selector.left)
+            if selector.combinator == ' ':
+                # Mark the subtrees of matching elements with +1 at their
+                # first descendant and -1 at their end.
+                indexes = np.flatnonzero(left)
+                delta = np.zeros(len(self) + 1, dtype=np.intp)
+                np.add.at(delta, indexes + 1, 1)
+                np.add.at(delta, self.ends[indexes], -1)
+                left = np.cumsum(delta[:-1]) > 0
+            elif selector.combinator == '>':
+                left = self._related(left, self.parents)
+            elif selector.combinator == '+':
+                left = self._related(left, self.previous)
+            elif selector.combinator == '~':
+                # Keep the position of the first matching child of parents.
+                indexes = np.flatnonzero(left & (self.parents >= 0))
+                first = np.full(len(self), len(self), dtype=np.intp)
+                np.minimum.at(first, self.parents[indexes], self.positions[indexes])
+                left = (self.parents >= 0) & (
+                    self.positions > first[self.parents])
+            else:
+                raise SelectorError('Unknown combinator', selector.combinator)
+            return left & self._mask(selector.right)
+
+        elif isinstance(selector, parser.CompoundSelector):
+            result = np.ones(len(self), dtype=bool)
+            for simple_selector in selector.simple_selectors:
+                result &= self._mask(simple_selector)
+            return result
+
+        elif isinstance(selector, parser.NegationSelector):
+            return ~self._any(selector.selector_list)
+
+        elif isinstance(selector, (
+                parser.MatchesAnySelector, parser.SpecificityAdjustmentSelector)):
+            return self._any(selector.selector_list)
+
+        elif isinstance(selector, parser.RelationalSelector):
+            result = self._zeros()
+            for relative_selector in selector.selector_list:
+                mask = self._mask(relative_selector.selector.parsed_tree)
+                if relative_selector.combinator == ' ':
+                    # Count matching elements before each element.
+                    counts = np.concatenate(([0], np.cumsum(mask)))
+                    elements = np.arange(len(self))
+                    result |= counts[self.ends] > counts[elements + 1]
+                elif relative_selector.combinator == '>':
+                    indexes = np.flatnonzero(mask & (self.parents >= 0))
+                    result[self.parents[indexes]] = True
+                elif relative_selector.combinator == '+':
+                    indexes = np.flatnonzero(mask & (self.previous >= 0))
+                    result[self.previous[indexes]] = True
+                elif relative_selector.combinator == '~':
+                    # Keep the position of the last matching child of parents.
+                    indexes = np.flatnonzero(mask & (self.parents >= 0))
+                    last = np.full(len(self), -1, dtype=np.intp)
+                    np.maximum.at(
+                        last, self.parents[indexes], self.positions[indexes])
+                    result |= (self.parents >= 0) & (
+                        self.positions < last[self.parents])
+            return result
+
+        # Masks of simple selectors are shared by all the selectors.
+        key = (type(selector), repr(selector))
+        if key not in self._masks:
+            self._masks[key] = self._simple_mask(selector)
+        return self._masks[key]
+
+    def _any(self, selector_list):
+        result = self._zeros()
+        for selector in selector_list:
+            result |= self._mask(selector.parsed_tree)
+        return result
+
+    def _simple_mask(self, selector):
+        if isinstance(selector, parser.LocalNameSelector):
+            local_name = (
+                selector.lower_local_name if self.in_html_document
+                else selector.local_name)
+            if local_name not in self._local_name_ids:
+                return self._zeros()
+            return self._local_names == self._local_name_ids[local_name]
+
+        elif isinstance(selector, parser.NamespaceSelector):
+            if selector.namespace not in self._namespace_ids:
+                return self._zeros()
+            return self._namespaces == self._namespace_ids[selector.namespace]
+
+        elif isinstance(selector, parser.ClassSelector):
+            if selector.class_name not in self._classes:
+                return self._zeros()
+            return self._from_indexes(self._classes[selector.class_name])
+
+        elif isinstance(selector, parser.IDSelector):
+            return self._equal_values('id', selector.ident)
+
+        elif isinstance(selector, parser.AttributeSelector):
+            return self._attribute_mask(selector)
+
+        elif isinstance(selector, parser.PseudoClassSelector):
+            if selector.name in parser.NEVER_MATCHING_PSEUDO_CLASSES:
+                return self._zeros()
+            elif selector.name in ('root', 'scope'):
+                return self.parents == -1
+            elif selector.name == 'first-child':
+                return self.positions == 0
+            elif selector.name == 'last-child':
+                return self.positions == self._sibling_counts - 1
+            elif selector.name == 'only-child':
+                return self._sibling_counts == 1
+            elif selector.name in ('first-of-type', 'last-of-type', 'only-of-type'):
+                positions, counts = self._type_positions(np.arange(len(self)))
+                if selector.name == 'first-of-type':
+                    return positions == 0
+                elif selector.name == 'last-of-type':
+                    return positions == counts - 1
+                return counts == 1
+            elif selector.name == 'empty':
+                return (self.ends == np.arange(1, len(self) + 1)) & ~self._texts
+
+        elif isinstance(selector, parser.FunctionalPseudoClassSelector):
+            if selector.name in (
+                    'nth-child', 'nth-last-child', 'nth-of-type',
+                    'nth-last-of-type'):
+                return self._nth_mask(selector)
+
+        else:
+            raise TypeError(type(selector), selector)
+
+        raise SelectorError(
+            f':{selector.name}',
+            f':{selector.name} can’t be matched on columnar documents')
+
+    def _attribute_mask(self, selector):
+        if selector.namespace is None:
+            raise SelectorError(
+                'Attribute in any namespace',
+                'Attributes in any namespace can’t be matched on columnar '
+                'documents')
+        name = selector.lower_name if self.in_html_document else selector.name
+        if selector.namespace:
+            name = f'{{{selector.namespace}}}{name}'
+        value = selector.value
+        if selector.case_sensitive is False:
+            value = value.lower()
+
+        if selector.operator is None:
+            if name not in self._attributes:
+                return self._zeros()
+            return self._from_indexes(self._attributes[name][0])
+        elif selector.operator == '=':
+            if selector.case_sensitive is not False:
+                return self._equal_values(name, value)
+
+            def test(attribute_value):
+                return attribute_value == value
+        elif selector.operator == '~=':
+            if len(value.split()) != 1 or value.strip() != value:
+                return self._zeros()
+
+            def test(attribute_value):
+                return value in split_whitespace(attribute_value)
+        elif selector.operator == '|=':
+            def test(attribute_value):
+                return (
+                    attribute_value == value or
+                    attribute_value.startswith(f'{value}-'))
+        elif not value:
+            return self._zeros()
+        elif selector.operator == '^=':
+            def test(attribute_value):
+                return attribute_value.startswith(value)
+        elif selector.operator == '$=':
+            def test(attribute_value):
+                return attribute_value.endswith(value)
+        elif selector.operator == '*=':
+            def test(attribute_value):
+                return value in attribute_value
+        else:
+            raise SelectorError('Unknown attribute operator', selector.operator)
+
+        if selector.case_sensitive is False:
+            return self._matching_values(
+                name, lambda attribute_value: test(attribute_value.lower()))
+        return self._matching_values(name, test)
+
+    def _equal_values(self, name, value):
+        """Return a mask of elements whose attribute is equal to ``value``."""
+        if name not in self._attributes:
+            return self._zeros()
+        indexes, codes, value_ids = self._attributes[name]
+        if value not in value_ids:
+            return self._zeros()
+        return self._from_indexes(indexes[codes == value_ids[value]])
+
+    def _matching_values(self, name, test):
+        """Return a mask of elements whose attribute value passes ``test``.
+
+        ``test`` is called once for each distinct value of the attribute.
+
+        """
+        if name not in self._attributes:
+            return self._zeros()
+        indexes, codes, value_ids = self._attributes[name]
+        matching = np.fromiter(
+            (test(value) for value in value_ids), dtype=bool,
+            count=len(value_ids))
+        return self._from_indexes(indexes[matching[codes]])
+
+    def _type_positions(self, elements):
+        """Return positions and counts among siblings with the same tag."""
+        groups = self.parents[elements] * len(self._tag_ids) + self.tags[elements]
+        return _group_positions(elements, groups)
+
+    def _nth_mask(self, selector):
+        nth, of_selectors = selector.split_nth_arguments()
+        result = parse_nth(nth)
+        if result is None:
+            raise SelectorError(f'Invalid arguments for :{selector.name}()')
+
+        # Same as the compiler, elements must match all the given selectors.
+        mask = np.ones(len(self), dtype=bool)
+        if of_selectors is not None:
+            for of_selector in of_selectors:
+                mask &= self._mask(of_selector.parsed_tree)
+        elements = np.flatnonzero(mask)
+        if selector.name in ('nth-child', 'nth-last-child'):
+            positions, counts = _group_positions(elements, self.parents[elements])
+        else:
+            positions, counts = self._type_positions(elements)
+        if selector.name.startswith('nth-last-'):
+            positions = counts - positions - 1
+
+        # Matches if a positive or zero integer n exists so that:
+        # position = a*n + b-1
+        a, b = result
+        if a == 0:
+            matching = positions == b - 1
+        else:
+            n, r = np.divmod(positions - (b - 1), a)
+            matching = (r == 0) & (n >= 0)
+        return self._from_indexes(elements[matching])
+
+
+def _group_positions(elements, groups):
+    """Return positions and counts of elements among elements of their group.
+
+    ``elements`` is an array of increasing element indexes, ``groups`` an
+    array of group ids of these elements.
+
+    """
+    order = np.lexsort((elements, groups))
+    sorted_groups = groups[order]
+    starts = np.ones(len(elements), dtype=bool)
+    starts[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    start_indexes = np.flatnonzero(starts)
+    group_numbers = np.cumsum(starts) - 1
+    counts = np.diff(np.append(start_indexes, len(elements)))
+    positions = np.empty(len(elements), dtype=np.intp)
+    positions[order] = np.arange(len(elements)) - start_indexes[group_numbers]
+    group_counts = np.empty(len(elements), dtype=np.intp)
+    group_counts[order] = counts[group_numbers]
+    return positions, group_counts
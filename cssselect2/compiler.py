@@ -1,17 +1,23 @@
+import ast
 import re
+from collections import Counter
+from itertools import islice
 from urllib.parse import urlparse
 
 from tinycss2.nth import parse_nth
 from webencodings import ascii_lower
 
-from . import parser
+from . import budget, parser, xpath
+from .metrics import cached_property, count_cache
 from .parser import SelectorError
 
 # http://dev.w3.org/csswg/selectors/#whitespace
 split_whitespace = re.compile('[^ \t\r\n\f]+').findall
 
+_SUPERSCRIPTS = {1: '', 2: '²', 3: '³'}
 
-def compile_selector_list(input, namespaces=None):
+
+def compile_selector_list(input, namespaces=None, lazy=False):
     """Compile a (comma-separated) list of selectors.
 
     :param input:
@@ -24,33 +30,62 @@ def compile_selector_list(input, namespaces=None):
         namespace.
         Values are namespace URLs as strings.
         If omitted, assume that no prefix is declared.
+    :param lazy:
+        Whether the selectors’ tests are only compiled when they are used for
+        the first time. Their sources are generated immediately, invalid
+        selectors raise :class:`SelectorError` in both cases.
     :returns:
         A list of opaque :class:`compiler.CompiledSelector` objects.
 
     """
-    return [CompiledSelector(selector) for selector in parser.parse(input, namespaces)]
+    return [
+        CompiledSelector(selector, lazy)
+        for selector in parser.parse(input, namespaces)]
 
 
 class CompiledSelector:
-    """Abstract representation of a selector."""
-    def __init__(self, parsed_selector):
-        source = _compile_node(parsed_selector.parsed_tree)
-        self.never_matches = source == '0'
-        eval_globals = {
-            'split_whitespace': split_whitespace,
-            'ascii_lower': ascii_lower,
-            'urlparse': urlparse,
-        }
-        self.test = eval('lambda el: ' + source, eval_globals, {})
+    """Abstract representation of a selector.
+
+    :param parsed_selector:
+        A selector returned by :func:`parser.parse`.
+    :param lazy:
+        Whether the test is only compiled when :attr:`test` is accessed for
+        the first time. :attr:`source` is generated immediately in both
+        cases, so that invalid selectors raise :class:`SelectorError`.
+        Bucketing metadata is available in both cases.
+
+    """
+    def __init__(self, parsed_selector, lazy=False):
+        self.parsed_selector = parsed_selector
+        self.lazy = lazy
+        self._tests = {}
+        self._etree_tests = {}
+        self._budgeted_tests = {}
+        self._element_paths = {}
+        self._xpath = {}
+        # Generating the source is cheap and raises errors early.
+        #: Python source of the test, as a boolean expression string.
+        self.source = _compile_node(parsed_selector.parsed_tree)
+        #: Whether the selector can’t match any element.
+        self.never_matches = self.source == '0'
+        if not lazy:
+            # Compile the test now. Attributes are set as usual instead of
+            # being cached by properties, keeping their access fast.
+            self.test = _eval_test(self.source)
         self.specificity = parsed_selector.specificity
         self.pseudo_element = parsed_selector.pseudo_element
         self.id = None
         self.class_name = None
+        self.class_names = []
         self.local_name = None
         self.lower_local_name = None
         self.namespace = None
         self.requires_lang_attr = False
 
+        #: Keys that must be found in a document for the selector to match,
+        #: as a :class:`frozenset` of ``(kind, key)`` tuples.
+        self.required_keys = frozenset(_required_keys(parsed_selector.parsed_tree))
+
         node = parsed_selector.parsed_tree
         if isinstance(node, parser.CombinedSelector):
             node = node.right
@@ -59,6 +94,7 @@ class CompiledSelector:
                 self.id = simple_selector.ident
             elif isinstance(simple_selector, parser.ClassSelector):
                 self.class_name = simple_selector.class_name
+                self.class_names.append(simple_selector.class_name)
             elif isinstance(simple_selector, parser.LocalNameSelector):
                 self.local_name = simple_selector.local_name
                 self.lower_local_name = simple_selector.lower_local_name
@@ -68,14 +104,496 @@ class CompiledSelector:
                 if simple_selector.name == 'lang':
                     self.requires_lang_attr = True
 
+    @cached_property
+    def dependencies(self):
+        """Keys whose changes may change the elements matched by the test.
+
+        A :class:`frozenset` of ``((kind, key), scope)`` tuples. ``kind`` is
+        ``'id'``, ``'class'``, ``'attribute'`` or ``'local_name'``, ``key`` is
+        the lowercase attribute or local name for the last two kinds, or
+        :obj:`None` for local names when the tags of all elements matter.
+        ``scope`` gives the elements whose matches may change when the key
+        changes on an element, as described by :meth:`Matcher.invalidated`.
+
+        """
+        return frozenset(_dependencies(self.parsed_selector.parsed_tree))
+
+    @cached_property
+    def cost_factors(self):
+        """Static estimate of the cost of the test.
+
+        A :class:`dict` of factors and exponents, where factors are
+        ``'depth'`` for ancestors, ``'siblings'`` for siblings and children,
+        and ``'subtree'`` for descendants whose wrappers are created by
+        ``:has()``. An empty dictionary means constant time.
+
+        """
+        return dict(sorted(_cost(self.parsed_selector.parsed_tree).items()))
+
+    @cached_property
+    def cost(self):
+        """Static estimate of the cost of the test, as a string.
+
+        For example, ``'O(1)'``, ``'O(depth)'`` or ``'O(siblings² × subtree)'``.
+
+        """
+        if not self.cost_factors:
+            return 'O(1)'
+        factors = ' × '.join(
+            f'{factor}{_SUPERSCRIPTS.get(exponent, f"^{exponent}")}'
+            for factor, exponent in self.cost_factors.items())
+        return f'O({factors})'
+
+    @cached_property
+    def test(self):
+        """Function returning whether an :class:`ElementWrapper` matches."""
+        return _eval_test(self.source)
+
+    def __getstate__(self):
+        # Functions created by eval can’t be pickled, the test is compiled
+        # again from its source when unpickled.
+        state = self.__dict__.copy()
+        state.pop('test', None)
+        state['_tests'] = {}
+        state['_etree_tests'] = {}
+        state['_budgeted_tests'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not self.lazy:
+            # Compile the test from its source now.
+            self.test = _eval_test(self.source)
+
+    def specialized_test(self, in_html_document):
+        """Return a function testing elements of a given document type.
+
+        Same as :attr:`test`, without checking the document type of tested
+        elements each time it’s needed.
+
+        :param in_html_document:
+            Whether tested elements are in an HTML document.
+        :returns:
+            A function returning whether an :class:`ElementWrapper` matches.
+
+        """
+        count_cache('specialized_test', in_html_document in self._tests)
+        if in_html_document not in self._tests:
+            source = _compile_node(
+                self.parsed_selector.parsed_tree, in_html_document)
+            if source == self.source and 'test' in self.__dict__:
+                # Test not depending on the document type, already compiled.
+                self._tests[in_html_document] = self.test
+            else:
+                self._tests[in_html_document] = _eval_test(source)
+        return self._tests[in_html_document]
+
+    def budgeted_test(self, in_html_document=None):
+        """Return a function testing elements in a :class:`budget.Budget`.
+
+        Same as :meth:`specialized_test`, or as :attr:`test` when
+        ``in_html_document`` is :obj:`None`, with a step counted for each
+        call and for each element visited by the loops of the test.
+
+        :param in_html_document:
+            Whether tested elements are in an HTML document, or :obj:`None`.
+        :returns:
+            A function returning whether an :class:`ElementWrapper` matches.
+
+        """
+        count_cache('budgeted_test', in_html_document in self._budgeted_tests)
+        if in_html_document not in self._budgeted_tests:
+            source = _compile_node(
+                self.parsed_selector.parsed_tree, in_html_document)
+            self._budgeted_tests[in_html_document] = _eval_test(
+                _budgeted_source(source))
+        return self._budgeted_tests[in_html_document]
+
+    def etree_test(self, in_html_document):
+        """Return a function testing ElementTree elements, if possible.
+
+        Selectors made of a single compound selector including only type, ID,
+        class and attribute selectors don’t need :class:`ElementWrapper`
+        objects to be tested.
+
+        :param in_html_document:
+            Whether tested elements are in an HTML document.
+        :returns:
+            A function returning whether an
+            :class:`xml.etree.ElementTree.Element` matches,
+            or :obj:`None` if the selector needs wrappers.
+
+        """
+        count_cache('etree_test', in_html_document in self._etree_tests)
+        if in_html_document not in self._etree_tests:
+            source = _compile_etree_node(
+                self.parsed_selector.parsed_tree, in_html_document)
+            test = None
+            if source is not None:
+                eval_globals = {'split_whitespace': split_whitespace}
+                test = eval('lambda e: ' + source, eval_globals, {})
+            self._etree_tests[in_html_document] = test
+        return self._etree_tests[in_html_document]
+
+    def element_path(self, in_html_document):
+        """Return an ElementPath expression finding matching descendants.
+
+        Only selectors made of a type selector, ID selectors and attribute
+        presence or equality selectors can be used with ElementTree’s
+        :meth:`xml.etree.ElementTree.Element.iterfind`.
+
+        :param in_html_document:
+            Whether elements are in an HTML document.
+        :returns:
+            An ElementPath expression string, or :obj:`None`.
+
+        """
+        count_cache('element_path', in_html_document in self._element_paths)
+        if in_html_document not in self._element_paths:
+            self._element_paths[in_html_document] = _compile_element_path(
+                self.parsed_selector.parsed_tree, in_html_document)
+        return self._element_paths[in_html_document]
+
+    def xpath(self, in_html_document):
+        """Return an XPath predicate equivalent to the test, if possible.
+
+        See :func:`xpath.translate`.
+
+        :param in_html_document:
+            Whether tested elements are in an HTML document.
+        :returns:
+            An XPath 1.0 boolean expression, or :obj:`None` if the selector
+            can’t be translated.
+
+        """
+        count_cache('xpath', in_html_document in self._xpath)
+        if in_html_document not in self._xpath:
+            self._xpath[in_html_document] = xpath.translate(
+                self.parsed_selector.parsed_tree, in_html_document)
+        return self._xpath[in_html_document]
+
+    def lazy_test(self, element):
+        """Same as :attr:`test`, without compiling the test before first call.
+
+        Useful to store a reference to the test of a lazy selector.
+
+        """
+        return self.test(element)
+
+
+def _eval_test(source):
+    """Return the test function of a boolean expression source."""
+    eval_globals = {
+        'split_whitespace': split_whitespace,
+        'ascii_lower': ascii_lower,
+        'urlparse': urlparse,
+        'islice': islice,
+        'previous_elements': _previous_elements,
+        'step': budget.step,
+        'steps': budget.steps,
+        'visits': budget.visits,
+    }
+    return eval('lambda el: ' + source, eval_globals, {})
+
+
+def _previous_elements(element):
+    """Iterate over previous siblings, in reversed tree order."""
+    element = element.previous
+    while element is not None:
+        yield element
+        element = element.previous
+
+
+class _BudgetedLoops(ast.NodeTransformer):
+    """Count a step for each item of comprehensions, and a visit for elements."""
+    def visit_comprehension(self, node):
+        self.generic_visit(node)
+        if isinstance(node.target, ast.Name) and node.target.id == 'el':
+            node.iter = ast.Call(ast.Name('visits', ast.Load()), [node.iter], [])
+        node.iter = ast.Call(ast.Name('steps', ast.Load()), [node.iter], [])
+        return node
+
+
+def _budgeted_source(source):
+    """Return a boolean expression source counting steps in a budget."""
+    tree = _BudgetedLoops().visit(ast.parse(source, mode='eval'))
+    return f'step() and ({ast.unparse(tree)})'
+
+
+def check_streamable(selector):
+    """Check that a selector can be matched while a document is parsed.
+
+    Selectors requiring the following siblings or the content of elements,
+    such as ``:last-child``, ``:nth-last-child()``, ``:has()`` or
+    ``:empty``, can’t be matched before the end of the parent or of the
+    element.
+
+    :param selector:
+        A :class:`CompiledSelector` object.
+    :raises:
+        :class:`SelectorError` if the selector can’t be streamed.
+
+    """
+    reason = _unstreamable_part(selector.parsed_selector.parsed_tree)
+    if reason is not None:
+        raise SelectorError(reason, f'{reason} can’t be matched while streaming')
+
+
+def _unstreamable_part(selector):
+    """Return the first part of a selector that can’t be streamed, or None."""
+    if isinstance(selector, parser.CombinedSelector):
+        return _unstreamable_part(selector.left) or _unstreamable_part(selector.right)
+    elif isinstance(selector, parser.CompoundSelector):
+        for simple_selector in selector.simple_selectors:
+            reason = _unstreamable_part(simple_selector)
+            if reason is not None:
+                return reason
+    elif isinstance(selector, parser.RelationalSelector):
+        return ':has()'
+    elif isinstance(selector, (
+            parser.NegationSelector, parser.MatchesAnySelector,
+            parser.SpecificityAdjustmentSelector)):
+        for selector in selector.selector_list:
+            reason = _unstreamable_part(selector.parsed_tree)
+            if reason is not None:
+                return reason
+    elif isinstance(selector, parser.PseudoClassSelector):
+        if selector.name in (
+                'last-child', 'last-of-type', 'only-child', 'only-of-type',
+                'empty'):
+            return f':{selector.name}'
+    elif isinstance(selector, parser.FunctionalPseudoClassSelector):
+        if selector.name in ('nth-last-child', 'nth-last-of-type'):
+            return f':{selector.name}()'
+        elif selector.name in ('nth-child', 'nth-of-type'):
+            for selector in selector.split_nth_arguments()[1] or ():
+                reason = _unstreamable_part(selector.parsed_tree)
+                if reason is not None:
+                    return reason
+
+
+def sibling_reach(selector):
+    """Return how many previous siblings a selector test can reach.
+
+    :param selector:
+        A :class:`CompiledSelector` object.
+    :returns:
+        The number of previous siblings, or :obj:`None` if all the previous
+        siblings can be reached.
+
+    """
+    return _sibling_reach(selector.parsed_selector.parsed_tree)
+
+
+def _sibling_reach(selector):
+    """Return how many previous siblings a selector can reach, or None."""
+    if isinstance(selector, parser.CombinedSelector):
+        left = _sibling_reach(selector.left)
+        right = _sibling_reach(selector.right)
+        if None in (left, right) or selector.combinator == '~':
+            return None
+        elif selector.combinator == '+':
+            return max(left + 1, right)
+        return max(left, right)
+    elif isinstance(selector, parser.CompoundSelector):
+        reaches = [
+            _sibling_reach(simple_selector)
+            for simple_selector in selector.simple_selectors]
+        return None if None in reaches else max(reaches, default=0)
+    elif isinstance(selector, (
+            parser.NegationSelector, parser.MatchesAnySelector,
+            parser.SpecificityAdjustmentSelector)):
+        reaches = [
+            _sibling_reach(selector.parsed_tree)
+            for selector in selector.selector_list]
+        return None if None in reaches else max(reaches, default=0)
+    elif isinstance(selector, parser.FunctionalPseudoClassSelector):
+        if (selector.name.startswith('nth-') and
+                selector.split_nth_arguments()[1] is not None):
+            return None
+    return 0
+
+
+def _cost(selector):
+    """Return the cost of a selector test as a Counter of factor exponents.
+
+    Costs of successive parts are combined with the maximum of each exponent,
+    an upper bound of their sum. Costs of tests run for each item of a
+    sequence are added to the exponent of the sequence factor.
+
+    """
+    if isinstance(selector, parser.CombinedSelector):
+        left = _cost(selector.left)
+        if selector.combinator == ' ':
+            left['depth'] += 1
+        elif selector.combinator == '~':
+            left['siblings'] += 1
+        return left | _cost(selector.right)
+    elif isinstance(selector, parser.CompoundSelector):
+        cost = Counter()
+        for simple_selector in selector.simple_selectors:
+            cost |= _cost(simple_selector)
+        return cost
+    elif isinstance(selector, (
+            parser.NegationSelector, parser.MatchesAnySelector,
+            parser.SpecificityAdjustmentSelector)):
+        cost = Counter()
+        for selector in selector.selector_list:
+            cost |= _cost(selector.parsed_tree)
+        return cost
+    elif isinstance(selector, parser.RelationalSelector):
+        cost = Counter()
+        for relative_selector in selector.selector_list:
+            relative_cost = _cost(relative_selector.selector.parsed_tree)
+            if relative_selector.combinator == ' ':
+                relative_cost['subtree'] += 1
+            elif relative_selector.combinator in ('>', '~'):
+                relative_cost['siblings'] += 1
+            cost |= relative_cost
+        return cost
+    elif isinstance(selector, parser.FunctionalPseudoClassSelector):
+        if selector.name.startswith('nth-'):
+            _, of_selectors = selector.split_nth_arguments()
+            if of_selectors is not None:
+                cost = Counter()
+                for of_selector in of_selectors:
+                    cost |= _cost(of_selector.parsed_tree)
+                cost['siblings'] += 1
+                return cost
+    return Counter()
+
+
+# Attributes used by pseudo-classes, and whether they apply to descendants
+_PSEUDO_CLASS_ATTRIBUTES = {
+    'link': (('href',), False),
+    'any-link': (('href',), False),
+    'local-link': (('href',), False),
+    'enabled': (('disabled', 'href'), True),
+    'disabled': (('disabled',), True),
+    'checked': (('checked', 'type', 'selected'), False),
+}
+_XML_LANG = ascii_lower('{http://www.w3.org/XML/1998/namespace}lang')
+
+
+def _scope(combinators):
+    """Return the scope of combinators, from a compound to the subject."""
+    if not combinators:
+        return 'self'
+    elif combinators[0] in (' ', '>'):
+        return 'descendants'
+    elif any(combinator in (' ', '>') for combinator in combinators[1:]):
+        return 'sibling_subtrees'
+    else:
+        return 'siblings'
+
+
+def _dependencies(selector, combinators=()):
+    """Yield the ``((kind, key), scope)`` tuples a selector depends on.
+
+    ``combinators`` are the combinators between the compound including the
+    selector and the subject of the whole selector.
+
+    """
+    if isinstance(selector, parser.CombinedSelector):
+        yield from _dependencies(selector.right, combinators)
+        yield from _dependencies(
+            selector.left, (selector.combinator, *combinators))
+    elif isinstance(selector, parser.CompoundSelector):
+        for simple_selector in selector.simple_selectors:
+            yield from _dependencies(simple_selector, combinators)
+    elif isinstance(selector, parser.IDSelector):
+        yield ('id', selector.ident), _scope(combinators)
+    elif isinstance(selector, parser.ClassSelector):
+        yield ('class', selector.class_name), _scope(combinators)
+    elif isinstance(selector, parser.LocalNameSelector):
+        yield ('local_name', selector.lower_local_name), _scope(combinators)
+    elif isinstance(selector, parser.NamespaceSelector):
+        # Namespaces are changed with tags, whatever their local name.
+        yield ('local_name', None), _scope(combinators)
+    elif isinstance(selector, parser.AttributeSelector):
+        name = selector.lower_name
+        if selector.namespace:
+            name = ascii_lower(f'{{{selector.namespace}}}{selector.name}')
+        yield ('attribute', name), _scope(combinators)
+    elif isinstance(selector, (
+            parser.NegationSelector, parser.MatchesAnySelector,
+            parser.SpecificityAdjustmentSelector)):
+        for selector in selector.selector_list:
+            yield from _dependencies(selector.parsed_tree, combinators)
+    elif isinstance(selector, parser.RelationalSelector):
+        # Changes in relative selectors change the matches of previous
+        # siblings or ancestors, that can only be found in the whole document.
+        for relative_selector in selector.selector_list:
+            for key, _ in _dependencies(relative_selector.selector.parsed_tree):
+                yield key, 'document'
+    elif isinstance(selector, parser.PseudoClassSelector):
+        if selector.name in _PSEUDO_CLASS_ATTRIBUTES:
+            names, inherited = _PSEUDO_CLASS_ATTRIBUTES[selector.name]
+            for name in names:
+                yield ('attribute', name), _scope(combinators)
+                if inherited:
+                    yield ('attribute', name), _scope((' ', *combinators))
+            yield ('local_name', None), _scope(combinators)
+            if inherited:
+                yield ('local_name', None), _scope((' ', *combinators))
+        elif selector.name.endswith('of-type'):
+            yield ('local_name', None), 'document'
+    elif isinstance(selector, parser.FunctionalPseudoClassSelector):
+        if selector.name == 'lang':
+            for name in ('lang', _XML_LANG):
+                yield ('attribute', name), _scope(combinators)
+                yield ('attribute', name), _scope((' ', *combinators))
+            # The lang attribute is ignored outside of the HTML namespace.
+            yield ('local_name', None), _scope(combinators)
+            yield ('local_name', None), _scope((' ', *combinators))
+            # Language may be given by a meta element.
+            for name in ('http-equiv', 'content'):
+                yield ('attribute', name), 'document'
+            yield ('local_name', 'meta'), 'document'
+        elif selector.name.startswith('nth-'):
+            if selector.name.endswith('of-type'):
+                yield ('local_name', None), 'document'
+            for of_selector in selector.split_nth_arguments()[1] or ():
+                for key, _ in _dependencies(of_selector.parsed_tree):
+                    yield key, 'document'
+
+
+def _required_keys(selector):
+    """Yield the ``(kind, key)`` tuples required by all compound selectors.
+
+    Only simple selectors found directly in compound selectors are taken into
+    account, keys found in functional pseudo-classes such as ``:is()`` are
+    not required.
+
+    """
+    while isinstance(selector, parser.CombinedSelector):
+        yield from _required_keys(selector.right)
+        selector = selector.left
+    for simple_selector in selector.simple_selectors:
+        if isinstance(simple_selector, parser.IDSelector):
+            yield 'id', simple_selector.ident
+        elif isinstance(simple_selector, parser.ClassSelector):
+            yield 'class', simple_selector.class_name
+        elif isinstance(simple_selector, parser.LocalNameSelector):
+            yield 'local_name', simple_selector.lower_local_name
+        elif isinstance(simple_selector, parser.NamespaceSelector):
+            yield 'namespace', simple_selector.namespace
+        elif isinstance(simple_selector, parser.AttributeSelector):
+            if simple_selector.namespace == '':
+                yield 'attribute', simple_selector.lower_name
 
-def _compile_node(selector):
+
+def _compile_node(selector, in_html_document=None):
     """Return a boolean expression, as a Python source string.
 
     When evaluated in a context where the `el` variable is an
     :class:`cssselect2.tree.Element` object, tells whether the element is a
     subject of `selector`.
 
+    ``in_html_document`` is :obj:`None` when the document type is only known
+    when testing, or a boolean to specialize the expression for HTML or XML
+    documents.
+
     """
     # To avoid precedence-related bugs, any sub-expression that is passed
     # around must be "atomic": add parentheses when the top-level would be
@@ -84,7 +602,7 @@ def _compile_node(selector):
     # 1 and 0 are used for True and False to avoid global lookups.
 
     if isinstance(selector, parser.CombinedSelector):
-        left_inside = _compile_node(selector.left)
+        left_inside = _compile_node(selector.left, in_html_document)
         if left_inside == '0':
             return '0'  # 0 and x == 0
         elif left_inside == '1':
@@ -108,11 +626,11 @@ def _compile_node(selector):
                 f'next(el is not None and ({left_inside}) '
                 'for el in [el.previous])')
         elif selector.combinator == '~':
-            left = f'any(({left_inside}) for el in el.previous_siblings)'
+            left = f'any(({left_inside}) for el in previous_elements(el))'
         else:
             raise SelectorError('Unknown combinator', selector.combinator)
 
-        right = _compile_node(selector.right)
+        right = _compile_node(selector.right, in_html_document)
         if right == '0':
             return '0'  # 0 and x == 0
         elif right == '1':
@@ -124,7 +642,7 @@ def _compile_node(selector):
     elif isinstance(selector, parser.CompoundSelector):
         sub_expressions = [
             expr for expr in [
-                _compile_node(selector)
+                _compile_node(selector, in_html_document)
                 for selector in selector.simple_selectors]
             if expr != '1']
         if len(sub_expressions) == 1:
@@ -139,7 +657,7 @@ def _compile_node(selector):
     elif isinstance(selector, parser.NegationSelector):
         sub_expressions = [
             expr for expr in [
-                _compile_node(selector.parsed_tree)
+                _compile_node(selector.parsed_tree, in_html_document)
                 for selector in selector.selector_list]
             if expr != '1']
         if not sub_expressions:
@@ -149,15 +667,16 @@ def _compile_node(selector):
     elif isinstance(selector, parser.RelationalSelector):
         sub_expressions = []
         for relative_selector in selector.selector_list:
-            expression = _compile_node(relative_selector.selector.parsed_tree)
+            expression = _compile_node(
+                relative_selector.selector.parsed_tree, in_html_document)
             if expression == '0':
                 continue
             if relative_selector.combinator == ' ':
-                elements = 'list(el.iter_subtree())[1:]'
+                elements = 'islice(el.iter_subtree(), 1, None)'
             elif relative_selector.combinator == '>':
                 elements = 'el.iter_children()'
             elif relative_selector.combinator == '+':
-                elements = 'list(el.iter_next_siblings())[:1]'
+                elements = 'islice(el.iter_next_siblings(), 1)'
             elif relative_selector.combinator == '~':
                 elements = 'el.iter_next_siblings()'
             sub_expressions.append(f'(any({expression} for el in {elements}))')
@@ -167,7 +686,7 @@ def _compile_node(selector):
             parser.MatchesAnySelector, parser.SpecificityAdjustmentSelector)):
         sub_expressions = [
             expr for expr in [
-                _compile_node(selector.parsed_tree)
+                _compile_node(selector.parsed_tree, in_html_document)
                 for selector in selector.selector_list]
             if expr != '0']
         if not sub_expressions:
@@ -177,10 +696,9 @@ def _compile_node(selector):
     elif isinstance(selector, parser.LocalNameSelector):
         if selector.lower_local_name == selector.local_name:
             return f'el.local_name == {selector.local_name!r}'
-        else:
-            return (
-                f'el.local_name == ({selector.lower_local_name!r} '
-                f'if el.in_html_document else {selector.local_name!r})')
+        local_name = _html_choice(
+            selector.lower_local_name, selector.local_name, in_html_document)
+        return f'el.local_name == {local_name}'
 
     elif isinstance(selector, parser.NamespaceSelector):
         return f'el.namespace_url == {selector.namespace!r}'
@@ -192,94 +710,46 @@ def _compile_node(selector):
         return f'el.id == {selector.ident!r}'
 
     elif isinstance(selector, parser.AttributeSelector):
-        if selector.namespace is not None:
-            if selector.namespace:
-                if selector.name == selector.lower_name:
-                    key = repr(f'{{{selector.namespace}}}{selector.name}')
-                else:
-                    lower = f'{{{selector.namespace}}}{selector.lower_name}'
-                    name = f'{{{selector.namespace}}}{selector.name}'
-                    key = f'({lower!r} if el.in_html_document else {name!r})'
-            else:
-                if selector.name == selector.lower_name:
-                    key = repr(selector.name)
-                else:
-                    lower, name = selector.lower_name, selector.name
-                    key = f'({lower!r} if el.in_html_document else {name!r})'
-            value = selector.value
-            attribute_value = f'el.etree_element.get({key}, "")'
-            if selector.case_sensitive is False:
-                value = value.lower()
-                attribute_value += '.lower()'
-            if selector.operator is None:
-                return f'{key} in el.etree_element.attrib'
-            elif selector.operator == '=':
-                return (
-                    f'{key} in el.etree_element.attrib and '
-                    f'{attribute_value} == {value!r}')
-            elif selector.operator == '~=':
-                return (
-                    '0' if len(value.split()) != 1 or value.strip() != value
-                    else f'{value!r} in split_whitespace({attribute_value})')
-            elif selector.operator == '|=':
-                return (
-                    f'{key} in el.etree_element.attrib and '
-                    f'{attribute_value} == {value!r} or '
-                    f'{attribute_value}.startswith({(value + "-")!r})')
-            elif selector.operator == '^=':
-                if value:
-                    return f'{attribute_value}.startswith({value!r})'
-                else:
-                    return '0'
-            elif selector.operator == '$=':
-                return (
-                    f'{attribute_value}.endswith({value!r})' if value else '0')
-            elif selector.operator == '*=':
-                return f'{value!r} in {attribute_value}' if value else '0'
-            else:
-                raise SelectorError('Unknown attribute operator', selector.operator)
-        else:  # In any namespace
-            raise NotImplementedError  # TODO
+        return _compile_attribute(selector, in_html_document=in_html_document)
 
     elif isinstance(selector, parser.PseudoClassSelector):
         if selector.name in ('link', 'any-link', 'local-link'):
-            test = html_tag_eq('a', 'area', 'link')
+            test = _html_tag_eq(('a', 'area', 'link'), in_html_document)
             test += ' and el.etree_element.get("href") is not None '
             if selector.name == 'local-link':
                 test += 'and not urlparse(el.etree_element.get("href")).scheme'
             return test
         elif selector.name == 'enabled':
-            input = html_tag_eq(
-                'button', 'input', 'select', 'textarea', 'option')
-            group = html_tag_eq('optgroup', 'menuitem', 'fieldset')
-            a = html_tag_eq('a', 'area', 'link')
+            input = _html_tag_eq(
+                ('button', 'input', 'select', 'textarea', 'option'),
+                in_html_document)
+            group = _html_tag_eq(
+                ('optgroup', 'menuitem', 'fieldset'), in_html_document)
+            a = _html_tag_eq(('a', 'area', 'link'), in_html_document)
             return (
                 f'({input} and el.etree_element.get("disabled") is None'
                 '  and not el.in_disabled_fieldset) or'
                 f'({group} and el.etree_element.get("disabled") is None) or '
                 f'({a} and el.etree_element.get("href") is not None)')
         elif selector.name == 'disabled':
-            input = html_tag_eq(
-                'button', 'input', 'select', 'textarea', 'option')
-            group = html_tag_eq('optgroup', 'menuitem', 'fieldset')
+            input = _html_tag_eq(
+                ('button', 'input', 'select', 'textarea', 'option'),
+                in_html_document)
+            group = _html_tag_eq(
+                ('optgroup', 'menuitem', 'fieldset'), in_html_document)
             return (
                 f'({input} and (el.etree_element.get("disabled") is not None'
                 '  or el.in_disabled_fieldset)) or'
                 f'({group} and el.etree_element.get("disabled") is not None)')
         elif selector.name == 'checked':
-            input = html_tag_eq('input', 'menuitem')
-            option = html_tag_eq('option')
+            input = _html_tag_eq(('input', 'menuitem'), in_html_document)
+            option = _html_tag_eq(('option',), in_html_document)
             return (
                 f'({input} and el.etree_element.get("checked") is not None and'
                 '  ascii_lower(el.etree_element.get("type", "")) '
                 '  in ("checkbox", "radio")) or ('
                 f'{option} and el.etree_element.get("selected") is not None)')
-        elif selector.name in (
-                'visited', 'hover', 'active', 'focus', 'focus-within',
-                'focus-visible', 'target', 'target-within', 'current', 'past',
-                'future', 'playing', 'paused', 'seeking', 'buffering',
-                'stalled', 'muted', 'volume-locked', 'user-valid',
-                'user-invalid', 'host'):
+        elif selector.name in parser.NEVER_MATCHING_PSEUDO_CLASSES:
             # Not applicable in a static context: never match.
             return '0'
         elif selector.name in ('root', 'scope'):
@@ -289,19 +759,13 @@ def _compile_node(selector):
         elif selector.name == 'last-child':
             return 'el.index + 1 == len(el.etree_siblings)'
         elif selector.name == 'first-of-type':
-            return (
-                'all(s.tag != el.etree_element.tag'
-                '    for s in el.etree_siblings[:el.index])')
+            return 'el.type_index == 0'
         elif selector.name == 'last-of-type':
-            return (
-                'all(s.tag != el.etree_element.tag'
-                '    for s in el.etree_siblings[el.index + 1:])')
+            return 'el.type_index + 1 == el.type_count'
         elif selector.name == 'only-child':
             return 'len(el.etree_siblings) == 1'
         elif selector.name == 'only-of-type':
-            return (
-                'all(s.tag != el.etree_element.tag or i == el.index'
-                '    for i, s in enumerate(el.etree_siblings))')
+            return 'el.type_count == 1'
         elif selector.name == 'empty':
             return 'not (el.etree_children or el.etree_element.text)'
         else:
@@ -329,60 +793,42 @@ def _compile_node(selector):
                 f'el.lang == {lang!r} or el.lang.startswith({(lang + "-")!r})'
                 for lang in langs)
         else:
-            nth = []
-            selector_list = []
-            current_list = nth
-            for argument in selector.arguments:
-                if argument.type == 'ident' and argument.value == 'of':
-                    if current_list is nth:
-                        current_list = selector_list
-                        continue
-                current_list.append(argument)
-
-            if selector_list:
+            nth, of_selectors = selector.split_nth_arguments()
+
+            if of_selectors is not None:
                 test = ' and '.join(
-                    _compile_node(selector.parsed_tree)
-                    for selector in parser.parse(selector_list))
+                    _compile_node(of_selector.parsed_tree, in_html_document)
+                    for of_selector in of_selectors)
                 if selector.name == 'nth-child':
                     count = (
-                        f'sum(1 for el in el.previous_siblings if ({test}))')
+                        f'sum(1 for el in previous_elements(el) if ({test}))')
                 elif selector.name == 'nth-last-child':
                     count = (
-                        'sum(1 for el in'
-                        '    tuple(el.iter_siblings())[el.index + 1:]'
-                        f'   if ({test}))')
+                        f'sum(1 for el in el.iter_next_siblings() if ({test}))')
                 elif selector.name == 'nth-of-type':
                     count = (
                         'sum(1 for s in ('
-                        '      el for el in el.previous_siblings'
+                        '      el for el in previous_elements(el)'
                         f'     if ({test}))'
                         '    if s.etree_element.tag == el.etree_element.tag)')
                 elif selector.name == 'nth-last-of-type':
                     count = (
                         'sum(1 for s in ('
-                        '      el for el in'
-                        '      tuple(el.iter_siblings())[el.index + 1:]'
+                        '      el for el in el.iter_next_siblings()'
                         f'     if ({test}))'
                         '    if s.etree_element.tag == el.etree_element.tag)')
                 else:
                     raise SelectorError('Unknown pseudo-class', selector.name)
                 count += f'if ({test}) else float("nan")'
             else:
-                if current_list is selector_list:
-                    raise SelectorError(
-                        f'Invalid arguments for :{selector.name}()')
                 if selector.name == 'nth-child':
                     count = 'el.index'
                 elif selector.name == 'nth-last-child':
                     count = 'len(el.etree_siblings) - el.index - 1'
                 elif selector.name == 'nth-of-type':
-                    count = (
-                        'sum(1 for s in el.etree_siblings[:el.index]'
-                        '    if s.tag == el.etree_element.tag)')
+                    count = 'el.type_index'
                 elif selector.name == 'nth-last-of-type':
-                    count = (
-                        'sum(1 for s in el.etree_siblings[el.index + 1:]'
-                        '    if s.tag == el.etree_element.tag)')
+                    count = 'el.type_count - el.type_index - 1'
                 else:
                     raise SelectorError('Unknown pseudo-class', selector.name)
 
@@ -409,18 +855,203 @@ def _compile_node(selector):
         raise TypeError(type(selector), selector)
 
 
+def _compile_etree_node(selector, in_html_document):
+    """Return a boolean expression testing an ElementTree element, or None.
+
+    When evaluated in a context where the `e` variable is an
+    :class:`xml.etree.ElementTree.Element` object, tells whether the element
+    is a subject of `selector`. Only compound selectors made of type, ID,
+    class and attribute selectors are supported, :obj:`None` is returned for
+    other selectors.
+
+    """
+    if not isinstance(selector, parser.CompoundSelector):
+        return None
+    sub_expressions = []
+    for simple_selector in selector.simple_selectors:
+        if isinstance(simple_selector, parser.LocalNameSelector):
+            local_name = (
+                simple_selector.lower_local_name if in_html_document
+                else simple_selector.local_name)
+            sub_expressions.append(
+                f'e.tag == {local_name!r} or (e.tag[:1] == "{{" and '
+                f'e.tag.endswith({"}" + local_name!r}))')
+        elif isinstance(simple_selector, parser.NamespaceSelector):
+            if simple_selector.namespace:
+                prefix = f'{{{simple_selector.namespace}}}'
+                sub_expressions.append(f'e.tag.startswith({prefix!r})')
+            else:
+                sub_expressions.append('e.tag[:1] != "{" or "}" not in e.tag')
+        elif isinstance(simple_selector, parser.IDSelector):
+            sub_expressions.append(f'e.get("id") == {simple_selector.ident!r}')
+        elif isinstance(simple_selector, parser.ClassSelector):
+            sub_expressions.append(
+                f'{simple_selector.class_name!r} in '
+                'split_whitespace(e.get("class", ""))')
+        elif isinstance(simple_selector, parser.AttributeSelector):
+            if simple_selector.namespace is None:
+                return None
+            sub_expressions.append(
+                _compile_attribute(simple_selector, 'e', in_html_document))
+        else:
+            return None
+    if '0' in sub_expressions:
+        return '0'
+    elif sub_expressions:
+        return ' and '.join(f'({expr})' for expr in sub_expressions)
+    else:
+        return '1'
+
+
+def _compile_element_path(selector, in_html_document):
+    """Return an ElementPath expression finding descendant subjects, or None.
+
+    The expression doesn’t find the context element itself.
+
+    """
+    if not isinstance(selector, parser.CompoundSelector):
+        return None
+    namespace = local_name = None
+    predicates = []
+    for simple_selector in selector.simple_selectors:
+        if isinstance(simple_selector, parser.LocalNameSelector):
+            local_name = (
+                simple_selector.lower_local_name if in_html_document
+                else simple_selector.local_name)
+        elif isinstance(simple_selector, parser.NamespaceSelector):
+            namespace = simple_selector.namespace
+        elif isinstance(simple_selector, parser.IDSelector):
+            predicates.append(('id', simple_selector.ident))
+        elif isinstance(simple_selector, parser.AttributeSelector):
+            if simple_selector.namespace != '':
+                return None
+            elif simple_selector.operator not in (None, '='):
+                return None
+            elif simple_selector.case_sensitive is False:
+                return None
+            name = (
+                simple_selector.lower_name if in_html_document
+                else simple_selector.name)
+            predicates.append((name, simple_selector.value))
+        else:
+            return None
+
+    if local_name is None:
+        # Namespace and universal selectors also find comments.
+        if namespace is not None or not predicates:
+            return None
+        tag = '*'
+    elif not xpath._simple_name(local_name):
+        return None
+    elif namespace is None:
+        tag = f'{{*}}{local_name}'
+    elif namespace:
+        tag = f'{{{namespace}}}{local_name}'
+    else:
+        tag = local_name
+
+    path = f'.//{tag}'
+    for name, value in predicates:
+        if not xpath._simple_name(name):
+            return None
+        elif value is None:
+            path += f'[@{name}]'
+        elif "'" not in value:
+            path += f"[@{name}='{value}']"
+        elif '"' not in value:
+            path += f'[@{name}="{value}"]'
+        else:
+            return None
+    return path
+
+
+def _compile_attribute(selector, etree_element='el.etree_element',
+                       in_html_document=None):
+    """Return a boolean expression for an attribute selector.
+
+    ``etree_element`` is the expression giving the tested ElementTree element.
+    ``in_html_document`` is :obj:`None` when the document type is only known
+    when testing, or a boolean when it is known at compile time.
+
+    """
+    if selector.namespace is None:  # In any namespace
+        raise NotImplementedError  # TODO
+    if selector.namespace:
+        lower = f'{{{selector.namespace}}}{selector.lower_name}'
+        name = f'{{{selector.namespace}}}{selector.name}'
+    else:
+        lower, name = selector.lower_name, selector.name
+    if lower == name:
+        key = repr(name)
+    else:
+        key = _html_choice(lower, name, in_html_document)
+    value = selector.value
+    attribute_value = f'{etree_element}.get({key}, "")'
+    if selector.case_sensitive is False:
+        value = value.lower()
+        if etree_element == 'el.etree_element':
+            # Wrappers cache lowercase values.
+            attribute_value = f'el.lower_attrib.get({key}, "")'
+        else:
+            attribute_value += '.lower()'
+    if selector.operator is None:
+        return f'{key} in {etree_element}.attrib'
+    elif selector.operator == '=':
+        return (
+            f'{key} in {etree_element}.attrib and '
+            f'{attribute_value} == {value!r}')
+    elif selector.operator == '~=':
+        return (
+            '0' if len(value.split()) != 1 or value.strip() != value
+            else f'{value!r} in split_whitespace({attribute_value})')
+    elif selector.operator == '|=':
+        return (
+            f'{key} in {etree_element}.attrib and '
+            f'{attribute_value} == {value!r} or '
+            f'{attribute_value}.startswith({(value + "-")!r})')
+    elif selector.operator == '^=':
+        if value:
+            return f'{attribute_value}.startswith({value!r})'
+        else:
+            return '0'
+    elif selector.operator == '$=':
+        return f'{attribute_value}.endswith({value!r})' if value else '0'
+    elif selector.operator == '*=':
+        return f'{value!r} in {attribute_value}' if value else '0'
+    else:
+        raise SelectorError('Unknown attribute operator', selector.operator)
+
+
+def _html_choice(html, xml, in_html_document):
+    """Return the expression of the value to use according to document type."""
+    if in_html_document is None:
+        return f'({html!r} if el.in_html_document else {xml!r})'
+    return repr(html if in_html_document else xml)
+
+
 def html_tag_eq(*local_names):
     """Generate expression testing equality with HTML local names."""
+    return _html_tag_eq(local_names, None)
+
+
+def _html_tag_eq(local_names, in_html_document):
+    """Generate expression testing equality with HTML local names.
+
+    ``in_html_document`` is :obj:`None` when the document type is only known
+    when testing, or a boolean when it is known at compile time.
+
+    """
     if len(local_names) == 1:
         tag = f'{{http://www.w3.org/1999/xhtml}}{local_names[0]}'
-        return (
-            f'((el.local_name == {local_names[0]!r}) if el.in_html_document '
-            f'else (el.etree_element.tag == {tag!r}))')
+        html = f'(el.local_name == {local_names[0]!r})'
+        xml = f'(el.etree_element.tag == {tag!r})'
     else:
         names = ', '.join(repr(n) for n in local_names)
         tags = ', '.join(
             repr(f'{{http://www.w3.org/1999/xhtml}}{name}')
             for name in local_names)
-        return (
-            f'((el.local_name in ({names})) if el.in_html_document '
-            f'else (el.etree_element.tag in ({tags})))')
+        html = f'(el.local_name in ({names}))'
+        xml = f'(el.etree_element.tag in ({tags}))'
+    if in_html_document is None:
+        return f'({html} if el.in_html_document else {xml})'
+    return html if in_html_document else xml
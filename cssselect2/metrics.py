@@ -0,0 +1,163 @@
+"""Count the work done by cssselect2.
+
+Counters are only collected in a :class:`Metrics` context. Counting hooks
+are installed when the first context is entered and removed when the last one
+exits, they cost nothing when no context is active::
+
+    with Metrics() as metrics:
+        for element in root.iter_subtree():
+            matcher.match(element)
+    print(metrics.as_dict())
+
+"""
+
+import functools
+from collections import Counter
+from contextvars import ContextVar
+from threading import Lock
+
+# Metrics object collecting counters in the current context
+_current = ContextVar('metrics', default=None)
+
+# Whether counting hooks are installed, true while a context is active
+installed = False
+
+# Number of active contexts in the process, protected by the lock
+_active = 0
+_lock = Lock()
+
+# Cached properties as (owner, name, property) tuples, and counted methods as
+# (class, method name, counter name) tuples, instrumented while hooks are
+# installed
+_properties = []
+_methods = []
+
+
+class Metrics:
+    """Context manager collecting counters.
+
+    Counters are collected in the current thread or asynchronous task while
+    the context is active, the work done in other threads or tasks is not
+    counted. Nested contexts replace the enclosing one until they exit.
+
+    Collected counters are:
+
+    - ``wrappers``, the number of created :class:`ElementWrapper` objects,
+    - ``computed.<name>``, the number of computations of the ``<name>`` cached
+      property of wrappers and compiled selectors,
+    - ``tests.<kind>``, the number of tests run by :meth:`Matcher.match` for
+      each kind of bucket, as returned by :meth:`Matcher.bucket`,
+    - ``cache.<name>.hits`` and ``cache.<name>.misses``, for compiled
+      selectors’ caches and documents’ class sets.
+
+    """
+    def __init__(self):
+        #: A :class:`collections.Counter` of collected counters.
+        self.counters = Counter()
+        self._tokens = []
+
+    def __enter__(self):
+        global _active
+        with _lock:
+            if not _active:
+                _install(True)
+            _active += 1
+        self._tokens.append(_current.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active
+        _current.reset(self._tokens.pop())
+        with _lock:
+            _active -= 1
+            if not _active:
+                _install(False)
+
+    def as_dict(self):
+        """Return counters as a dictionary.
+
+        :returns:
+            A :class:`dict` of counter names and values, including
+            ``cache.<name>.hit_rate`` ratios between 0 and 1 for caches.
+
+        """
+        result = dict(sorted(self.counters.items()))
+        caches = {
+            key.rsplit('.', 1)[0] for key in result
+            if key.startswith('cache.') and result[key]}
+        for name in sorted(caches):
+            hits = result.get(f'{name}.hits', 0)
+            misses = result.get(f'{name}.misses', 0)
+            result[f'{name}.hit_rate'] = hits / (hits + misses)
+        return result
+
+
+class cached_property(functools.cached_property):  # noqa: N801
+    """:func:`functools.cached_property` counted in :class:`Metrics` contexts.
+
+    Properties are replaced by :class:`_CountedProperty` objects while
+    counting hooks are installed.
+
+    """
+    def __set_name__(self, owner, name):
+        super().__set_name__(owner, name)
+        _properties.append((owner, name, self))
+
+
+class _CountedProperty(functools.cached_property):
+    """:func:`functools.cached_property` counting computations."""
+    def __get__(self, instance, owner=None):
+        # Only called when the value is not cached yet.
+        if instance is not None and (metrics := _current.get()) is not None:
+            metrics.counters[f'computed.{self.attrname}'] += 1
+        return super().__get__(instance, owner)
+
+
+def counted(name, method='__init__'):
+    """Return a class decorator counting calls of ``method`` as ``name``."""
+    def decorator(cls):
+        _methods.append((cls, method, name))
+        return cls
+    return decorator
+
+
+def _counted(function, name):
+    """Return ``function`` counting its calls as ``name``."""
+    @functools.wraps(function)
+    def counted_function(*args, **kwargs):
+        if (metrics := _current.get()) is not None:
+            metrics.counters[name] += 1
+        return function(*args, **kwargs)
+    return counted_function
+
+
+def _install(install):
+    """Install or remove counting hooks."""
+    global installed
+    for owner, name, property in _properties:
+        if install:
+            counted_property = _CountedProperty(property.func)
+            counted_property.__set_name__(owner, name)
+            counted_property.__doc__ = property.__doc__
+            setattr(owner, name, counted_property)
+        else:
+            setattr(owner, name, property)
+    for cls, method, name in _methods:
+        function = cls.__dict__[method]
+        if install:
+            setattr(cls, method, _counted(function, name))
+        else:
+            setattr(cls, method, function.__wrapped__)
+    installed = install
+
+
+def count(name, value=1):
+    """Add ``value`` to the counter called ``name``."""
+    if installed and (metrics := _current.get()) is not None:
+        metrics.counters[name] += value
+
+
+def count_cache(name, hit):
+    """Count a hit or a miss of the cache called ``name``."""
+    if installed and (metrics := _current.get()) is not None:
+        metrics.counters[f'cache.{name}.{"hits" if hit else "misses"}'] += 1
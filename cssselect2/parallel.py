@@ -0,0 +1,191 @@
+"""Match selectors against many documents in parallel."""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from xml.etree import ElementTree
+
+from . import Matcher
+from .tree import ElementWrapper
+
+# Set in each worker process by _initialize_worker
+_worker = None
+
+# Cached properties computed before sharing wrappers between threads
+_SHARED_PROPERTIES = (
+    'etree_children', '_children_types', 'type_index', 'type_count',
+    'local_name', 'namespace_url', 'id', 'classes', 'lower_attrib', 'lang',
+    'in_disabled_fieldset')
+
+
+def match_documents(documents, selectors, workers=None, chunk_size=16,
+                    in_html_document=False, content_language=None):
+    """Match selectors against documents in a pool of processes.
+
+    Documents are sent to the workers by chunks. Only a few chunks per worker
+    are queued at once, so that huge or infinite iterables of documents can be
+    given.
+
+    :param documents:
+        An iterable of documents, each one being an ElementTree
+        :class:`xml.etree.ElementTree.Element`,
+        an :class:`xml.etree.ElementTree.ElementTree`,
+        or a path to an XML file parsed by the workers.
+    :param selectors:
+        Either a :class:`Matcher`,
+        or a list of selectors, each one being a
+        :class:`compiler.CompiledSelector`
+        or an argument to :func:`compile_selector_list`.
+    :param workers:
+        The number of worker processes,
+        defaults to the number of processors.
+    :param chunk_size:
+        The number of documents sent at once to a worker.
+    :param in_html_document:
+        Whether documents are wrapped with :meth:`ElementWrapper.from_html_root`
+        instead of :meth:`ElementWrapper.from_xml_root`.
+    :param content_language:
+        The content language given to the wrappers.
+    :returns:
+        An iterator of results, in the order of the given documents.
+        With a :class:`Matcher`, each result is a list of ``(index, matches)``
+        tuples, where ``index`` is the position of a matching element in tree
+        order, and ``matches`` is the list returned by :meth:`Matcher.match`.
+        With a list of selectors, each result is the list of the positions of
+        the matching elements in tree order.
+
+    """
+    if isinstance(selectors, Matcher):
+        # Payloads stay in this process, workers only get and send back
+        # selectors’ order.
+        state = selectors.__getstate__()
+        payloads = {entry[1]: entry[3] for _, entry in state['_selectors']}
+        state['_selectors'] = [
+            (selector, (*entry[:3], None))
+            for selector, entry in state['_selectors']]
+        selectors = state
+    else:
+        payloads = None
+        selectors = ElementWrapper._compile_selectors(selectors)
+    workers = workers or os.cpu_count() or 1
+    initargs = (selectors, in_html_document, content_language)
+    documents = iter(documents)
+    with ProcessPoolExecutor(workers, None, _initialize_worker, initargs) as pool:
+        futures = deque()
+        while True:
+            while len(futures) < 2 * workers:
+                chunk = list(islice(documents, chunk_size))
+                if not chunk:
+                    break
+                futures.append(pool.submit(_match_chunk, chunk))
+            if not futures:
+                return
+            for result in futures.popleft().result():
+                if payloads is not None:
+                    result = [
+                        (index, [
+                            (specificity, order, pseudo, payloads[order])
+                            for specificity, order, pseudo in matches])
+                        for index, matches in result]
+                yield result
+
+
+def match_subtrees(matcher, root, workers=None, depth=3):
+    """Match selectors against the elements of a document in threads.
+
+    The document is split into subtrees matched in a pool of threads, sharing
+    the given matcher. This is only useful with free-threaded Python builds.
+
+    The elements at the top of the document, whose wrappers are shared by the
+    threads as parents or previous siblings, are matched and their cached
+    properties are computed before the subtrees are sent to the threads. Each
+    thread then only creates and modifies the wrappers of its own subtrees,
+    and only reads the shared ones. The matcher, its selectors and the
+    underlying ElementTree elements must not be modified during matching.
+
+    :param matcher:
+        A :class:`Matcher`.
+    :param root:
+        An :class:`ElementWrapper`, usually the root of a document.
+    :param workers:
+        The number of threads, defaults to the number of processors.
+    :param depth:
+        The maximum depth of the elements whose subtrees are sent to threads.
+    :returns:
+        An iterator of ``(element, matches)`` tuples for all the elements of
+        the subtree rooted at ``root``, in tree order, where ``matches`` is
+        the list returned by :meth:`Matcher.match`.
+
+    """
+    workers = workers or os.cpu_count() or 1
+    # Split the document into subtrees, expanding the top elements one level
+    # at a time until there are enough subtrees for all the threads. Units are
+    # (is_subtree, element) tuples, expanded elements are matched alone.
+    units = [(True, root)]
+    for _ in range(depth):
+        if sum(is_subtree for is_subtree, _ in units) >= 4 * workers:
+            break
+        expanded = []
+        for is_subtree, element in units:
+            expanded.append((False, element))
+            if is_subtree:
+                expanded.extend(
+                    (True, child) for child in element.iter_children())
+        units = expanded
+
+    # Compute shared wrappers’ caches before sharing them.
+    for _, element in units:
+        for name in _SHARED_PROPERTIES:
+            getattr(element, name)
+
+    with ThreadPoolExecutor(workers) as pool:
+        subtrees = pool.map(
+            partial(_match_subtree, matcher),
+            [element for is_subtree, element in units if is_subtree])
+        for is_subtree, element in units:
+            if is_subtree:
+                yield from next(subtrees)
+            else:
+                yield element, matcher.match(element)
+
+
+def _match_subtree(matcher, root):
+    return [
+        (element, matcher.match(element)) for element in root.iter_subtree()]
+
+
+def _initialize_worker(selectors, in_html_document, content_language):
+    global _worker
+    if isinstance(selectors, dict):
+        tests = None
+        selectors, state = Matcher.__new__(Matcher), selectors
+        # Specialize tests for the type of the documents.
+        selectors.__setstate__({**state, 'in_html_document': in_html_document})
+    else:
+        tests = [
+            selector.specialized_test(in_html_document) for selector in selectors]
+    _worker = (selectors, tests, in_html_document, content_language)
+
+
+def _match_chunk(documents):
+    selectors, tests, in_html_document, content_language = _worker
+    results = []
+    for document in documents:
+        if isinstance(document, (str, os.PathLike)):
+            document = ElementTree.parse(document)
+        root = ElementWrapper._from_root(
+            document, content_language, in_html_document)
+        result = []
+        if tests is None:
+            for index, element in enumerate(root.iter_subtree()):
+                matches = selectors.match(element)
+                if matches:
+                    result.append((index, [match[:3] for match in matches]))
+        else:
+            for index, element in enumerate(root.iter_subtree()):
+                if any(test(element) for test in tests):
+                    result.append(index)
+        results.append(result)
+    return results
@@ -1,4 +1,4 @@
-from tinycss2 import parse_component_value_list
+from tinycss2 import parse_component_value_list, serialize
 
 __all__ = ['parse']
 
@@ -13,6 +13,13 @@ SUPPORTED_PSEUDO_ELEMENTS = {
     'content', 'shadow',
 }
 
+# Pseudo-classes that never match in a static context
+NEVER_MATCHING_PSEUDO_CLASSES = frozenset((
+    'visited', 'hover', 'active', 'focus', 'focus-within', 'focus-visible',
+    'target', 'target-within', 'current', 'past', 'future', 'playing',
+    'paused', 'seeking', 'buffering', 'stalled', 'muted', 'volume-locked',
+    'user-valid', 'user-invalid', 'host'))
+
 
 def parse(input, namespaces=None, forgiving=False, relative=False):
     """Yield tinycss2 selectors found in given ``input``.
@@ -462,7 +469,23 @@ class FunctionalPseudoClassSelector:
         self.arguments = arguments
 
     def __repr__(self):
-        return f':{self.name}{tuple(self.arguments)!r}'
+        return f':{self.name}({serialize(self.arguments)})'
+
+    def split_nth_arguments(self):
+        """Split the arguments of ``:nth-*()`` pseudo-classes.
+
+        Return a ``(nth, selectors)`` tuple, where ``nth`` is the list of
+        tokens before ``of``, and ``selectors`` the list of :class:`Selector`
+        objects parsed after ``of``, or :obj:`None` without ``of``.
+
+        """
+        for i, argument in enumerate(self.arguments):
+            if argument.type == 'ident' and argument.value == 'of':
+                selectors = self.arguments[i + 1:]
+                if not selectors:
+                    raise SelectorError(f'Invalid arguments for :{self.name}()')
+                return self.arguments[:i], list(parse(selectors))
+        return self.arguments, None
 
 
 class NegationSelector:
@@ -1,11 +1,23 @@
-from functools import cached_property
+from itertools import chain
 from warnings import warn
+from xml.etree.ElementTree import iterparse
 
 from webencodings import ascii_lower
 
-from .compiler import compile_selector_list, split_whitespace
+from . import budget
+from .compiler import (
+    check_streamable,
+    compile_selector_list,
+    sibling_reach,
+    split_whitespace,
+)
+from .metrics import cached_property, count_cache, counted
 
+_FIELDSET = '{http://www.w3.org/1999/xhtml}fieldset'
+_LEGEND = '{http://www.w3.org/1999/xhtml}legend'
 
+
+@counted('wrappers')
 class ElementWrapper:
     """Wrapper of :class:`xml.etree.ElementTree.Element` for Selector matching.
 
@@ -17,6 +29,21 @@ class ElementWrapper:
     :class:`ElementWrapper` objects compare equal if their underlying
     :class:`xml.etree.ElementTree.Element` do.
 
+    Subclasses can adapt other kinds of trees, as :class:`LxmlElementWrapper`
+    does. Compiled selectors only rely on this protocol:
+
+    - :attr:`etree_element`, with ``tag``, ``text``, ``get()`` and ``attrib``,
+    - :attr:`in_html_document`,
+    - the :attr:`parent` and :attr:`previous` wrappers,
+    - :attr:`ancestors` and :attr:`previous_siblings`, iterables of wrappers,
+    - :attr:`index`, :attr:`type_index`, :attr:`type_count`,
+      :attr:`etree_siblings` and :attr:`etree_children`,
+    - :meth:`iter_children`, :meth:`iter_next_siblings`,
+      :meth:`iter_siblings` and :meth:`iter_subtree`,
+    - the tag split into :attr:`local_name` and :attr:`namespace_url`,
+    - :attr:`id`, :attr:`classes`, :attr:`lower_attrib`, :attr:`lang` and
+      :attr:`in_disabled_fieldset`.
+
     """
     @classmethod
     def from_xml_root(cls, root, content_language=None):
@@ -32,6 +59,13 @@ class ElementWrapper:
         :returns:
             A new :class:`ElementWrapper`
 
+        Data depending on the whole document, such as the languages of the
+        elements and the states of disabled fieldsets, is computed once and
+        shared by all the wrappers created from the returned root. When the
+        document is changed in place, :meth:`invalidate` has to be called on
+        the wrapper of the changed element, or the root has to be wrapped
+        again.
+
         .. _scoped: https://drafts.csswg.org/selectors-4/#scoping
 
         """
@@ -47,6 +81,105 @@ class ElementWrapper:
         """
         return cls._from_root(root, content_language, in_html_document=True)
 
+    @classmethod
+    def iterparse(cls, source, *selectors, in_html_document=False,
+                  content_language=None):
+        """Parse a document and yield elements matching given selectors.
+
+        The document is parsed incrementally with
+        :func:`xml.etree.ElementTree.iterparse`, and matching elements are
+        yielded as soon as they are closed, with their whole subtree. Once
+        closed, elements are removed from their parent unless they are in a
+        matching element, and siblings are only kept as far as needed by
+        selectors using sibling combinators. Documents larger than memory can
+        thus be queried.
+
+        Yielded elements keep their subtree, but they are removed from their
+        parent’s ElementTree element once the iterator is resumed. Their
+        :attr:`etree_siblings` are not available, and their :attr:`previous`
+        siblings are forgotten when following siblings are parsed, unless
+        selectors need them.
+
+        Selectors requiring following siblings or the content of elements are
+        not supported, see :func:`compiler.check_streamable`. The
+        ``Content-Language`` of HTML ``meta`` elements is only taken into
+        account if it has already been parsed when needed.
+
+        :param source:
+            A file name or a file object containing XML data.
+        :param selectors:
+            Each given selector is either a :class:`compiler.CompiledSelector`,
+            or an argument to :func:`compile_selector_list`.
+        :param in_html_document:
+            Whether the document is considered as an HTML document, as with
+            :meth:`from_html_root`.
+        :param content_language:
+            The content language of the document, as with
+            :meth:`from_xml_root`.
+        :returns:
+            An iterator of newly-created :class:`ElementWrapper` objects, in
+            the order of their end tags.
+        :raises:
+            :class:`SelectorError` if a selector can’t be streamed.
+
+        """
+        selectors = cls._compile_selectors(selectors)
+        for selector in selectors:
+            check_streamable(selector)
+        tests = [
+            selector.specialized_test(in_html_document) for selector in selectors]
+
+        # Number of previous siblings that tests can reach, at least one
+        reaches = [sibling_reach(selector) for selector in selectors]
+        reach = None if None in reaches else max([1, *reaches])
+
+        # Stack of [wrapper, matches, last closed child wrapper, tag counts]
+        stack = []
+        open_matches = 0
+        for event, etree_element in iterparse(source, ('start', 'end')):
+            if event == 'start':
+                if stack:
+                    parent, _, previous, type_counts = stack[-1]
+                    index = 0 if previous is None else previous.index + 1
+                    element = cls(
+                        etree_element, parent, index, previous, in_html_document)
+                    element.previous = previous
+                    element.type_index = type_counts.get(etree_element.tag, 0)
+                    type_counts[etree_element.tag] = element.type_index + 1
+                    if reach is not None:
+                        # Forget siblings that can’t be reached by tests.
+                        sibling = element
+                        for _ in range(reach):
+                            sibling = sibling.previous
+                            if sibling is None:
+                                break
+                        else:
+                            sibling.previous = None
+                else:
+                    element = cls(
+                        etree_element, None, 0, None, in_html_document,
+                        content_language)
+                    # The document is built and emptied while parsing.
+                    element._document.static = False
+                # Children are not kept.
+                element.etree_children = []
+                matches = any(test(element) for test in tests)
+                open_matches += matches
+                stack.append([element, matches, None, {}])
+            else:
+                element, matches, _, _ = stack.pop()
+                if stack:
+                    stack[-1][2] = element
+                if matches:
+                    open_matches -= 1
+                    # Children are computed again from the kept subtree.
+                    del element.etree_children
+                    yield element
+                if stack and not open_matches:
+                    # Previous siblings have been removed, the closed element
+                    # is the first child of its parent.
+                    stack[-1][0].etree_element.remove(etree_element)
+
     @classmethod
     def _from_root(cls, root, content_language, in_html_document=True):
         if hasattr(root, 'getroot'):
@@ -62,9 +195,9 @@ class ElementWrapper:
         #: The parent :class:`ElementWrapper`,
         #: or :obj:`None` for the root element.
         self.parent = parent
-        #: The previous sibling :class:`ElementWrapper`,
-        #: or :obj:`None` for the root element.
-        self.previous = previous
+        if previous is not None or index == 0:
+            # Otherwise, computed when needed.
+            self.previous = previous
         if parent is not None:
             #: The :attr:`parent`’s children
             #: as a list of
@@ -78,11 +211,29 @@ class ElementWrapper:
         self.index = index
         self.in_html_document = in_html_document
         self.transport_content_language = content_language
+        if parent is None:
+            self._document = _Document(
+                etree_element, in_html_document, content_language)
+        else:
+            self._document = parent._document
 
         # Cache
         self._ancestors = None
         self._previous_siblings = None
 
+    @cached_property
+    def previous(self):
+        """The previous sibling :class:`ElementWrapper`.
+
+        :obj:`None` for the root element and for first children.
+
+        """
+        # Only computed for wrappers created without their previous sibling.
+        index = self.index - 1
+        return type(self)(
+            self.etree_siblings[index], self.parent, index, None,
+            self.in_html_document)
+
     def __eq__(self, other):
         return (
             type(self) is type(other) and
@@ -106,8 +257,16 @@ class ElementWrapper:
 
         """
         if self._ancestors is None:
-            self._ancestors = (
-                () if self.parent is None else (*self.parent.ancestors, self.parent))
+            # Compute missing tuples from the top, avoiding recursion.
+            missing = []
+            element = self
+            while element is not None and element._ancestors is None:
+                missing.append(element)
+                element = element.parent
+            for element in reversed(missing):
+                parent = element.parent
+                element._ancestors = (
+                    () if parent is None else (*parent._ancestors, parent))
         return self._ancestors
 
     @property
@@ -119,9 +278,17 @@ class ElementWrapper:
 
         """
         if self._previous_siblings is None:
-            self._previous_siblings = (
-                () if self.previous is None else
-                (*self.previous.previous_siblings, self.previous))
+            # Compute missing tuples from the first sibling, avoiding recursion.
+            missing = []
+            element = self
+            while element is not None and element._previous_siblings is None:
+                missing.append(element)
+                element = element.previous
+            for element in reversed(missing):
+                previous = element.previous
+                element._previous_siblings = (
+                    () if previous is None else
+                    (*previous._previous_siblings, previous))
         return self._previous_siblings
 
     def iter_ancestors(self):
@@ -182,12 +349,14 @@ class ElementWrapper:
         this element’s next siblings, in tree order.
 
         """
-        found = False
-        for sibling in self.iter_siblings():
-            if found:
-                yield sibling
-            if sibling == self:
-                found = True
+        if self.parent is None:
+            return
+        previous = self
+        for index in range(self.index + 1, len(self.etree_siblings)):
+            previous = type(self)(
+                self.etree_siblings[index], parent=self.parent, index=index,
+                previous=previous, in_html_document=self.in_html_document)
+            yield previous
 
     def iter_children(self):
         """Iterate over children.
@@ -228,14 +397,53 @@ class ElementWrapper:
                 yield element
                 stack.append(element.iter_children())
 
+    def invalidate(self, attribute=None):
+        """Clear cached data after this element has been changed in place.
+
+        Data cached by this wrapper and its ancestors, and data computed at
+        once for the whole document, such as languages and states of disabled
+        fieldsets, are computed again when needed. Without this call, queries
+        from the same root keep using outdated data. Other existing wrappers may
+        keep outdated data, wrappers of other elements have to be created
+        again from the root.
+
+        :param attribute:
+            The name of the changed attribute, or :obj:`None` when the tag or
+            the children of the element have changed.
+
+        """
+        for name in (
+                'id', 'classes', 'lower_attrib', 'local_name', 'namespace_url',
+                'type_index', 'type_count', 'lang', 'in_disabled_fieldset'):
+            self.__dict__.pop(name, None)
+        for element in (self, *self.ancestors):
+            for name in (
+                    'etree_children', '_children_types', 'lang',
+                    'in_disabled_fieldset'):
+                element.__dict__.pop(name, None)
+        self._document.invalidate(attribute)
+
+    def _compile(self, selectors):
+        return self._tests(self._compile_selectors(selectors))
+
+    def _tests(self, compiled_selectors):
+        if budget.active():
+            return [
+                compiled_selector.budgeted_test(self.in_html_document)
+                for compiled_selector in compiled_selectors]
+        return [
+            compiled_selector.specialized_test(self.in_html_document)
+            for compiled_selector in compiled_selectors]
+
     @staticmethod
-    def _compile(selectors):
+    def _compile_selectors(selectors):
         return [
-            compiled_selector.test
+            compiled_selector
             for selector in selectors
             for compiled_selector in (
-                [selector] if hasattr(selector, 'test')
-                else compile_selector_list(selector))
+                [selector] if hasattr(selector, 'parsed_selector')
+                # Generic tests are not needed, only specialized ones.
+                else compile_selector_list(selector, lazy=True))
             if compiled_selector.pseudo_element is None and
             not compiled_selector.never_matches]
 
@@ -263,16 +471,180 @@ class ElementWrapper:
             An iterator of newly-created :class:`ElementWrapper` objects.
 
         """
-        tests = self._compile(selectors)
+        selectors = self._compile_selectors(selectors)
+        if any(selector.source == '1' for selector in selectors):
+            # Universal selector, all elements match.
+            return self.iter_subtree()
+        if not budget.active():
+            # Searches in native code can’t be stopped by budgets.
+            expression = self._xpath(selectors)
+            if expression is not None:
+                return self._wrap_descendants(
+                    self.etree_element.xpath(expression), _lxml_parent)
+            etree_elements = self._element_path_matches(selectors)
+            if etree_elements is not None:
+                return self._wrap_descendants(
+                    etree_elements, self._parent_getter())
+        tests = self._tests(selectors)
+        elements = self.iter_subtree()
+        if budget.active():
+            elements = budget.visits(elements)
         if len(tests) == 1:
-            return filter(tests[0], self.iter_subtree())
+            return filter(tests[0], elements)
         elif selectors:
             return (
-                element for element in self.iter_subtree()
+                element for element in elements
+                if any(test(element) for test in tests))
+        else:
+            return iter(())
+
+    def query_all_etree(self, *selectors):
+        """Return ElementTree elements matching any of given selectors.
+
+        Same as :meth:`query_all`, but return the underlying
+        :class:`xml.etree.ElementTree.Element` objects. When all the selectors
+        only include type, ID, class and attribute selectors, no
+        :class:`ElementWrapper` is created, unless a :class:`budget.Budget` is
+        enforced.
+
+        :param selectors:
+            Each given selector is either a :class:`compiler.CompiledSelector`,
+            or an argument to :func:`compile_selector_list`.
+        :returns:
+            An iterator of :class:`xml.etree.ElementTree.Element` objects,
+            in tree order.
+
+        """
+        selectors = self._compile_selectors(selectors)
+        if budget.active():
+            # Searches in native code and tests of ElementTree elements can’t
+            # be stopped by budgets.
+            return (
+                element.etree_element for element in self.query_all(*selectors))
+        expression = self._xpath(selectors)
+        if expression is not None:
+            return iter(self.etree_element.xpath(expression))
+        etree_elements = self._element_path_matches(selectors)
+        if etree_elements is not None:
+            return etree_elements
+        tests = [
+            selector.etree_test(self.in_html_document) for selector in selectors]
+        if None in tests:
+            return (
+                element.etree_element for element in self.query_all(*selectors))
+        elements = (
+            element for element in self.etree_element.iter()
+            if isinstance(element.tag, str))
+        if len(tests) == 1:
+            return filter(tests[0], elements)
+        elif tests:
+            return (
+                element for element in elements
                 if any(test(element) for test in tests))
         else:
             return iter(())
 
+    def count(self, *selectors):
+        """Return the number of elements matching any of given selectors.
+
+        :param selectors:
+            Each given selector is either a :class:`compiler.CompiledSelector`,
+            or an argument to :func:`compile_selector_list`.
+
+        """
+        selectors = self._compile_selectors(selectors)
+        expression = None if budget.active() else self._xpath(selectors)
+        if expression is not None:
+            return int(self.etree_element.xpath(f'count({expression})'))
+        return sum(1 for _ in self.query_all_etree(*selectors))
+
+    def _xpath(self, selectors):
+        """Return an XPath expression selecting matching descendants, or None.
+
+        XPath is only used for lxml documents, when all selectors can be
+        translated and when the root of the wrappers is the real root of the
+        document.
+
+        """
+        if not selectors or not hasattr(self.etree_element, 'xpath'):
+            return None
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        if root.etree_element.getparent() is not None:
+            return None
+        predicates = [
+            selector.xpath(self.in_html_document) for selector in selectors]
+        if None in predicates:
+            return None
+        predicate = ' or '.join(f'({predicate})' for predicate in predicates)
+        return f'descendant-or-self::*[{predicate}]'
+
+    def _element_path_matches(self, selectors):
+        """Return matching ElementTree elements found by ElementPath, or None.
+
+        ElementPath is used when all selectors can be translated, letting
+        ElementTree find candidates without creating wrappers.
+
+        """
+        if not selectors:
+            return None
+        paths = [
+            selector.element_path(self.in_html_document) for selector in selectors]
+        if None in paths:
+            return None
+        tests = [
+            selector.etree_test(self.in_html_document) for selector in selectors]
+        root = self.etree_element
+        # Element paths only find descendants, the root is tested separately.
+        root_matches = any(test(root) for test in tests)
+        if len(paths) == 1:
+            descendants = root.iterfind(paths[0])
+            return chain((root,), descendants) if root_matches else descendants
+        matches = {element for path in paths for element in root.iterfind(path)}
+        if root_matches:
+            matches.add(root)
+        return (element for element in root.iter() if element in matches)
+
+    def _parent_getter(self):
+        """Return a function giving the parent of elements in this subtree."""
+        parents = {}
+
+        def get_parent(etree_element):
+            if not parents:
+                parents.update(
+                    (child, parent) for parent in self.etree_element.iter()
+                    for child in parent)
+            return parents[etree_element]
+
+        return get_parent
+
+    def _wrap_descendants(self, etree_elements, get_parent):
+        """Yield wrappers for given elements of this element’s subtree.
+
+        Only the wrappers of given elements and of their ancestors are
+        created. ``get_parent`` is a function returning the parent of an
+        ElementTree element.
+
+        """
+        wrappers = {self.etree_element: self}
+        indexes = {}
+        for etree_element in etree_elements:
+            path = []
+            while etree_element not in wrappers:
+                path.append(etree_element)
+                etree_element = get_parent(etree_element)
+            wrapper = wrappers[etree_element]
+            for etree_child in reversed(path):
+                if wrapper not in indexes:
+                    indexes[wrapper] = {
+                        child: index for index, child
+                        in enumerate(wrapper.etree_children)}
+                wrapper = wrappers[etree_child] = type(self)(
+                    etree_child, wrapper, indexes[wrapper][etree_child], None,
+                    self.in_html_document)
+            yield wrapper
+
     def query(self, *selectors):
         """Return first element that matches any of given selectors.
 
@@ -301,6 +673,39 @@ class ElementWrapper:
             element for element in self.etree_element
             if isinstance(element.tag, str)]
 
+    @cached_property
+    def type_index(self):
+        """The number of previous siblings with the same tag as this element.
+
+        Computed at once for all the children of the :attr:`parent`.
+
+        """
+        if self.parent is None:
+            return 0
+        return self.parent._children_types[0][self.index]
+
+    @cached_property
+    def type_count(self):
+        """The number of siblings with the same tag, including this element.
+
+        Computed at once for all the children of the :attr:`parent`.
+
+        """
+        if self.parent is None:
+            return 1
+        return self.parent._children_types[1][self.etree_element.tag]
+
+    @cached_property
+    def _children_types(self):
+        """List of children :attr:`type_index` and dict of tag counts."""
+        counts = {}
+        indexes = []
+        for child in self.etree_children:
+            index = counts.get(child.tag, 0)
+            indexes.append(index)
+            counts[child.tag] = index + 1
+        return indexes, counts
+
     @cached_property
     def local_name(self):
         """The local name of this element, as a string."""
@@ -320,31 +725,114 @@ class ElementWrapper:
         """The ID of this element, as a string."""
         return self.etree_element.get('id')
 
+    @cached_property
+    def lower_attrib(self):
+        """The attributes of this element, with lowercase values.
+
+        Used by case-insensitive attribute selectors.
+
+        """
+        return {
+            name: value.lower()
+            for name, value in self.etree_element.attrib.items()}
+
     @cached_property
     def classes(self):
-        """The classes of this element, as a :class:`set` of strings."""
-        return set(split_whitespace(self.etree_element.get('class', '')))
+        """The classes of this element, as a :class:`frozenset` of strings.
+
+        Elements of a document with the same ``class`` attribute share the
+        same set.
+
+        """
+        value = self.etree_element.get('class', '')
+        class_sets = self._document.class_sets
+        count_cache('class_sets', value in class_sets)
+        if value not in class_sets:
+            class_sets[value] = frozenset(split_whitespace(value))
+        return class_sets[value]
 
     @cached_property
     def lang(self):
-        """The language of this element, as a string."""
-        # http://whatwg.org/C#language
-        xml_lang = self.etree_element.get('{http://www.w3.org/XML/1998/namespace}lang')
-        if xml_lang is not None:
-            return ascii_lower(xml_lang)
+        """The language of this element, as a string.
+
+        Languages of all the elements of a document are computed at once
+        when the language of one of them is first needed, and are kept until
+        :meth:`invalidate` is called.
+
+        """
+        languages = self._document.languages or {}
+        element = self
+        while True:
+            if element.etree_element in languages:
+                return languages[element.etree_element]
+            elif element is not self and 'lang' in element.__dict__:
+                return element.lang
+            # Element not in the document when languages have been computed.
+            lang = _element_lang(element.etree_element, self.in_html_document)
+            if lang is not None:
+                return lang
+            elif element.parent is None:
+                return self._document.root_lang
+            element = element.parent
+
+    @cached_property
+    def in_disabled_fieldset(self):
+        """Whether this element is disabled by a fieldset ancestor.
+
+        Computed at once for all the elements of a document, and kept until
+        :meth:`invalidate` is called.
+
+        """
+        states = self._document.disabled_fieldset_states
+        if states is not None and self.etree_element in states:
+            return states[self.etree_element]
+        # Element not in the document when states have been computed.
+        element = self
+        while element.parent is not None:
+            if element is not self and 'in_disabled_fieldset' in element.__dict__:
+                return element.in_disabled_fieldset
+            parent = element.parent.etree_element
+            if _is_disabled_fieldset(parent):
+                etree_element = element.etree_element
+                if etree_element.tag != _LEGEND or element.type_index:
+                    return True
+            element = element.parent
+        return False
+
+
+class _Document:
+    """State shared by the wrappers of a document."""
+    def __init__(self, root, in_html_document, content_language):
+        self.root = root
+        self.in_html_document = in_html_document
+        self.content_language = content_language
+        # Whether the document is complete, allowing document-wide caches
+        self.static = True
+        # Sets of classes, by class attribute value
+        self.class_sets = {}
+
+    def invalidate(self, attribute=None):
+        """Clear the caches depending on an attribute, or on tags if None."""
+        name = None if attribute is None else ascii_lower(attribute)
+        if name is None or name.rpartition('}')[2] in (
+                'lang', 'http-equiv', 'content'):
+            self.__dict__.pop('root_lang', None)
+            self.__dict__.pop('languages', None)
+        if name in (None, 'disabled'):
+            self.__dict__.pop('disabled_fieldset_states', None)
+
+    @cached_property
+    def root_lang(self):
+        """Language of the root element."""
+        lang = _element_lang(self.root, self.in_html_document)
+        if lang is not None:
+            return lang
         is_html = (
             self.in_html_document or
-            self.namespace_url == 'http://www.w3.org/1999/xhtml')
-        if is_html:
-            lang = self.etree_element.get('lang')
-            if lang is not None:
-                return ascii_lower(lang)
-        if self.parent is not None:
-            return self.parent.lang
-        # Root elememnt
+            _split_etree_tag(self.root.tag)[0] == 'http://www.w3.org/1999/xhtml')
         if is_html:
             content_language = None
-            iterator = self.etree_element.iter('{http://www.w3.org/1999/xhtml}meta')
+            iterator = self.root.iter('{http://www.w3.org/1999/xhtml}meta')
             for meta in iterator:
                 http_equiv = meta.get('http-equiv', '')
                 if ascii_lower(http_equiv) == 'content-language':
@@ -352,21 +840,189 @@ class ElementWrapper:
             if content_language is not None:
                 return ascii_lower(content_language)
         # Empty string means unknown
-        return _parse_content_language(self.transport_content_language) or ''
+        return _parse_content_language(self.content_language) or ''
 
     @cached_property
-    def in_disabled_fieldset(self):
+    def languages(self):
+        """Languages of the elements, by ElementTree element.
+
+        Languages are computed for all the elements in a single pass, from the
+        root to the leaves. :obj:`None` if the document is not static.
+
+        """
+        if not self.static:
+            return None
+        languages = {self.root: self.root_lang}
+        stack = [self.root]
+        while stack:
+            parent = stack.pop()
+            parent_lang = languages[parent]
+            for child in parent:
+                if isinstance(child.tag, str):
+                    lang = _element_lang(child, self.in_html_document)
+                    languages[child] = parent_lang if lang is None else lang
+                    stack.append(child)
+        return languages
+
+    @cached_property
+    def disabled_fieldset_states(self):
+        """Whether elements are disabled by fieldsets, by ElementTree element.
+
+        Elements are disabled by disabled fieldset ancestors, unless they are
+        or are in the first legend child of these fieldsets. States are
+        computed for all the elements in a single pass, from the root to the
+        leaves. :obj:`None` if the document is not static.
+
+        """
+        if not self.static:
+            return None
+        states = {self.root: False}
+        stack = [self.root]
+        while stack:
+            parent = stack.pop()
+            parent_state = states[parent]
+            disabled_fieldset = _is_disabled_fieldset(parent)
+            first_legend = True
+            for child in parent:
+                if not isinstance(child.tag, str):
+                    continue
+                state = parent_state
+                if disabled_fieldset:
+                    if child.tag == _LEGEND and first_legend:
+                        first_legend = False
+                    else:
+                        state = True
+                states[child] = state
+                stack.append(child)
+        return states
+
+
+@counted('wrappers', '_new_wrapper')
+class LxmlElementWrapper(ElementWrapper):
+    """Wrapper of :class:`lxml.etree._Element` for Selector matching.
+
+    Parents and siblings are found with lxml’s ``getparent()``,
+    ``getprevious()`` and ``getnext()`` methods. Wrappers can then be created
+    for any element of the document without creating wrappers for all the
+    preceding elements, and :attr:`ancestors` and :attr:`previous_siblings`
+    are lazy iterators instead of tuples.
+
+    """
+    def __init__(self, etree_element, parent, index, previous,
+                 in_html_document, content_language=None):
+        super().__init__(
+            etree_element, parent, index, previous, in_html_document,
+            content_language)
+        self._root = self if parent is None else parent._root
+
+    def _wrap(self, etree_element, **attributes):
+        """Return a wrapper for another element of the document."""
+        if etree_element == self._root.etree_element:
+            return self._root
+        return self._new_wrapper(etree_element, attributes)
+
+    def _new_wrapper(self, etree_element, attributes):
+        """Create a wrapper for another element of the document."""
+        wrapper = type(self).__new__(type(self))
+        wrapper.etree_element = etree_element
+        wrapper.in_html_document = self.in_html_document
+        wrapper.transport_content_language = None
+        wrapper._root = self._root
+        wrapper._document = self._document
+        wrapper.__dict__.update(attributes)
+        return wrapper
+
+    @cached_property
+    def parent(self):
+        """The parent wrapper, or :obj:`None` for the root element."""
+        return self._wrap(self.etree_element.getparent())
+
+    @cached_property
+    def previous(self):
+        """The previous sibling :class:`ElementWrapper`.
+
+        :obj:`None` for the root element and for first children.
+
+        """
+        if self.parent is None:
+            return None
+        sibling = self.etree_element.getprevious()
+        while sibling is not None and not isinstance(sibling.tag, str):
+            sibling = sibling.getprevious()
+        if sibling is not None:
+            return self._wrap(sibling, parent=self.parent)
+
+    @cached_property
+    def index(self):
+        """The position within the :attr:`parent`’s children, counting from 0."""
+        if self.parent is None:
+            return 0
+        return sum(
+            1 for sibling in self.etree_element.itersiblings(preceding=True)
+            if isinstance(sibling.tag, str))
+
+    @cached_property
+    def etree_siblings(self):
+        """The :attr:`parent`’s children as a list of lxml elements."""
+        if self.parent is None:
+            return [self.etree_element]
+        return self.parent.etree_children
+
+    @property
+    def ancestors(self):
+        """Iterator of ancestors, from :attr:`parent` to the root."""
+        element = self.parent
+        while element is not None:
+            yield element
+            element = element.parent
+
+    @property
+    def previous_siblings(self):
+        """Iterator of previous siblings, in reversed tree order."""
+        element = self.previous
+        while element is not None:
+            yield element
+            element = element.previous
+
+    def iter_next_siblings(self):
         if self.parent is None:
-            return False
-        fieldset = '{http://www.w3.org/1999/xhtml}fieldset'
-        legend = '{http://www.w3.org/1999/xhtml}legend'
-        disabled_fieldset = (
-            self.parent.etree_element.tag == fieldset and
-            self.parent.etree_element.get('disabled') is not None and (
-                self.etree_element.tag != legend or any(
-                    sibling.etree_element.tag == legend
-                    for sibling in self.iter_previous_siblings())))
-        return disabled_fieldset or self.parent.in_disabled_fieldset
+            return
+        previous = self
+        sibling = self.etree_element.getnext()
+        while sibling is not None:
+            if isinstance(sibling.tag, str):
+                previous = self._wrap(
+                    sibling, parent=self.parent, previous=previous)
+                yield previous
+            sibling = sibling.getnext()
+
+    def _wrap_descendants(self, etree_elements, get_parent):
+        return (self._wrap(etree_element) for etree_element in etree_elements)
+
+
+def _lxml_parent(etree_element):
+    return etree_element.getparent()
+
+
+def _is_disabled_fieldset(etree_element):
+    return (
+        etree_element.tag == _FIELDSET and
+        etree_element.get('disabled') is not None)
+
+
+def _element_lang(etree_element, in_html_document):
+    """Return the language set by an element’s attributes, or None."""
+    # http://whatwg.org/C#language
+    xml_lang = etree_element.get('{http://www.w3.org/XML/1998/namespace}lang')
+    if xml_lang is not None:
+        return ascii_lower(xml_lang)
+    is_html = (
+        in_html_document or
+        _split_etree_tag(etree_element.tag)[0] == 'http://www.w3.org/1999/xhtml')
+    if is_html:
+        lang = etree_element.get('lang')
+        if lang is not None:
+            return ascii_lower(lang)
 
 
 def _split_etree_tag(tag):
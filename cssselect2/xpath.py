@@ -0,0 +1,249 @@
+"""Translate parsed selectors into XPath expressions.
+
+XPath expressions can be evaluated natively by lxml, much faster than
+compiled Python tests. Selectors whose semantics can’t be expressed in XPath
+1.0, such as ``:lang()``, ``:enabled`` or ``:nth-of-type()``, are not
+translated.
+
+"""
+
+import re
+
+from tinycss2.nth import parse_nth
+
+from . import parser
+
+XHTML_NAMESPACE = 'http://www.w3.org/1999/xhtml'
+
+# Attribute names that can be used as XPath name tests
+_simple_name = re.compile(r'[A-Za-z_][A-Za-z0-9_.-]*\Z').match
+
+
+class _UnsupportedError(Exception):
+    """Raised when a selector can’t be translated."""
+
+
+def translate(selector, in_html_document=False):
+    """Return an XPath predicate telling whether an element is a subject.
+
+    :param selector:
+        A parsed selector tree, such as the
+        :attr:`compiler.CompiledSelector.parsed_selector`’s ``parsed_tree``.
+    :param in_html_document:
+        Whether the tested elements are in an HTML document.
+    :returns:
+        An XPath 1.0 boolean expression, evaluated with the tested element as
+        context node, or :obj:`None` if the selector can’t be translated.
+
+    """
+    try:
+        return _translate(selector, in_html_document)
+    except _UnsupportedError:
+        return None
+
+
+def _translate(selector, html):
+    if isinstance(selector, parser.CombinedSelector):
+        left = _translate(selector.left, html)
+        right = _translate(selector.right, html)
+        if selector.combinator == ' ':
+            axis = 'ancestor::*'
+        elif selector.combinator == '>':
+            axis = 'parent::*'
+        elif selector.combinator == '+':
+            axis = 'preceding-sibling::*[1]'
+        elif selector.combinator == '~':
+            axis = 'preceding-sibling::*'
+        else:
+            raise _UnsupportedError
+        if left != 'true()':
+            axis += f'[{left}]'
+        return axis if right == 'true()' else f'({right}) and {axis}'
+
+    elif isinstance(selector, parser.CompoundSelector):
+        expressions = [
+            expression for expression in (
+                _translate(selector, html)
+                for selector in selector.simple_selectors)
+            if expression != 'true()']
+        if not expressions:
+            return 'true()'
+        return ' and '.join(f'({expression})' for expression in expressions)
+
+    elif isinstance(selector, parser.NegationSelector):
+        # Same as the compiler, ignore selectors matching everything.
+        expressions = [
+            expression for expression in (
+                _translate(selector.parsed_tree, html)
+                for selector in selector.selector_list)
+            if expression != 'true()']
+        if not expressions:
+            return 'false()'
+        return f'not({" or ".join(f"({expression})" for expression in expressions)})'
+
+    elif isinstance(selector, (
+            parser.MatchesAnySelector, parser.SpecificityAdjustmentSelector)):
+        expressions = [
+            expression for expression in (
+                _translate(selector.parsed_tree, html)
+                for selector in selector.selector_list)
+            if expression != 'false()']
+        if not expressions:
+            return 'false()'
+        return ' or '.join(f'({expression})' for expression in expressions)
+
+    elif isinstance(selector, parser.RelationalSelector):
+        expressions = []
+        for relative_selector in selector.selector_list:
+            expression = _translate(relative_selector.selector.parsed_tree, html)
+            if relative_selector.combinator == ' ':
+                axis = 'descendant::*'
+            elif relative_selector.combinator == '>':
+                axis = 'child::*'
+            elif relative_selector.combinator == '+':
+                axis = 'following-sibling::*[1]'
+            elif relative_selector.combinator == '~':
+                axis = 'following-sibling::*'
+            expressions.append(f'{axis}[{expression}]')
+        if not expressions:
+            return 'false()'
+        return ' or '.join(expressions)
+
+    elif isinstance(selector, parser.LocalNameSelector):
+        name = selector.lower_local_name if html else selector.local_name
+        return f'local-name() = {_string(name)}'
+
+    elif isinstance(selector, parser.NamespaceSelector):
+        return f'namespace-uri() = {_string(selector.namespace)}'
+
+    elif isinstance(selector, parser.ClassSelector):
+        return (
+            'contains(concat(" ", normalize-space(@class), " "), '
+            f'{_string(f" {selector.class_name} ")})')
+
+    elif isinstance(selector, parser.IDSelector):
+        return f'@id = {_string(selector.ident)}'
+
+    elif isinstance(selector, parser.AttributeSelector):
+        if selector.namespace is None or selector.case_sensitive is False:
+            raise _UnsupportedError
+        name = selector.lower_name if html else selector.name
+        if selector.namespace == '' and _simple_name(name):
+            attribute = f'@{name}'
+        else:
+            attribute = (
+                f'@*[local-name() = {_string(name)} and '
+                f'namespace-uri() = {_string(selector.namespace)}]')
+        value = selector.value
+        if selector.operator is None:
+            return attribute
+        elif selector.operator == '=':
+            return f'{attribute} = {_string(value)}'
+        elif selector.operator == '~=':
+            if len(value.split()) != 1 or value.strip() != value:
+                return 'false()'
+            return (
+                f'contains(concat(" ", normalize-space({attribute}), " "), '
+                f'{_string(f" {value} ")})')
+        elif selector.operator == '|=':
+            return (
+                f'{attribute} = {_string(value)} or '
+                f'starts-with({attribute}, {_string(f"{value}-")})')
+        elif not value:
+            return 'false()'
+        elif selector.operator == '^=':
+            return f'starts-with({attribute}, {_string(value)})'
+        elif selector.operator == '$=':
+            return (
+                f'substring({attribute}, string-length({attribute}) - '
+                f'{len(value) - 1}) = {_string(value)}')
+        elif selector.operator == '*=':
+            return f'contains({attribute}, {_string(value)})'
+        else:
+            raise _UnsupportedError
+
+    elif isinstance(selector, parser.PseudoClassSelector):
+        if selector.name in ('link', 'any-link'):
+            return f'({_html_tag_eq(html, "a", "area", "link")}) and @href'
+        elif selector.name == 'checked':
+            input = _html_tag_eq(html, 'input', 'menuitem')
+            option = _html_tag_eq(html, 'option')
+            type = (
+                'translate(@type, "ABCDEFGHIJKLMNOPQRSTUVWXYZ", '
+                '"abcdefghijklmnopqrstuvwxyz")')
+            return (
+                f'(({input}) and @checked and '
+                f'({type} = "checkbox" or {type} = "radio")) or '
+                f'(({option}) and @selected)')
+        elif selector.name in parser.NEVER_MATCHING_PSEUDO_CLASSES:
+            return 'false()'
+        elif selector.name in ('root', 'scope'):
+            return 'not(parent::*)'
+        elif selector.name == 'first-child':
+            return 'not(preceding-sibling::*)'
+        elif selector.name == 'last-child':
+            return 'not(following-sibling::*)'
+        elif selector.name == 'only-child':
+            return 'not(preceding-sibling::*) and not(following-sibling::*)'
+        elif selector.name == 'empty':
+            # Only text before the first child counts, as in ElementTree.
+            return 'not(*) and not(node()[1][self::text()])'
+        else:
+            raise _UnsupportedError
+
+    elif isinstance(selector, parser.FunctionalPseudoClassSelector):
+        if selector.name not in ('nth-child', 'nth-last-child'):
+            raise _UnsupportedError
+        try:
+            nth, of_selectors = selector.split_nth_arguments()
+        except parser.SelectorError:
+            raise _UnsupportedError from None
+        result = parse_nth(nth)
+        if result is None:
+            raise _UnsupportedError
+
+        if selector.name == 'nth-child':
+            axis = 'preceding-sibling::*'
+        else:
+            axis = 'following-sibling::*'
+        if of_selectors is not None:
+            test = ' and '.join(
+                f'({_translate(of_selector.parsed_tree, html)})'
+                for of_selector in of_selectors)
+            count = f'count({axis}[{test}])'
+        else:
+            test = None
+            count = f'count({axis})'
+
+        a, b = result
+        # Same equations as in the compiler
+        B = b - 1  # noqa: N806
+        if a == 0:
+            expression = f'{count} = {B}'
+        else:
+            expression = (
+                f'({count} - {B}) mod {a} = 0 and '
+                f'({count} - {B}) div {a} >= 0')
+        return expression if test is None else f'({test}) and {expression}'
+
+    else:
+        raise _UnsupportedError
+
+
+def _html_tag_eq(html, *local_names):
+    """Generate expression testing equality with HTML local names."""
+    names = ' or '.join(
+        f'local-name() = {_string(name)}' for name in local_names)
+    if html:
+        return names
+    return f'namespace-uri() = "{XHTML_NAMESPACE}" and ({names})'
+
+
+def _string(value):
+    """Return an XPath string literal."""
+    if "'" not in value:
+        return f"'{value}'"
+    elif '"' not in value:
+        return f'"{value}"'
+    parts = ', '.join(_string(part) for part in re.split('(\')', value) if part)
+    return f'concat({parts}, "")'
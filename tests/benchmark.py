@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""Benchmark cssselect2 hot paths.
+
+Launch from the root of the repository::
+
+    python -m tests.benchmark --output results.json
+    python -m tests.benchmark --baseline results.json
+
+Times are the best of ``--repeat`` runs, divided by the number of loops in each
+run. When a baseline is given, benchmarks slower than the baseline by more than
+``--threshold`` are reported and the command exits with an error.
+
+With ``--scaling``, the growth of the runtime of compilation and matchers with
+the size of stylesheets is checked instead. Timings depend on the machine, these
+checks are not included in the test suite, that counts operations instead.
+
+"""
+
+import argparse
+import json
+import platform
+import sys
+import timeit
+from math import log
+from pathlib import Path
+from xml.etree import ElementTree
+
+import cssselect2
+
+from . import synthetic
+from .w3_selectors import valid_selectors
+
+CURRENT_FOLDER = Path(__file__).parent
+
+
+def make_stylesheet():
+    """Return a list of selector strings from W3C tests and synthetic rules."""
+    selectors = [
+        test['selector'] for test in valid_selectors
+        if not set(test.get('exclude', ())) & {'document', 'xhtml'}]
+    return selectors + synthetic.stylesheet(1000)
+
+
+def compile_valid(selectors):
+    """Return compiled selectors, ignoring unsupported ones."""
+    compiled = []
+    for selector in selectors:
+        try:
+            compiled.extend(cssselect2.compile_selector_list(selector))
+        except (cssselect2.SelectorError, NotImplementedError):
+            pass
+    return compiled
+
+
+def make_benchmarks():
+    """Return a dictionary of benchmark names and functions."""
+    shakespeare = cssselect2.ElementWrapper.from_xml_root(
+        ElementTree.parse(CURRENT_FOLDER / 'shakespeare.html'))
+    content = cssselect2.ElementWrapper.from_xml_root(
+        ElementTree.parse(CURRENT_FOLDER / 'content.xhtml'))
+    document = synthetic.tree(depth=5, width=5)
+    stylesheet = make_stylesheet()
+    compiled = compile_valid(stylesheet)
+    matcher = cssselect2.Matcher()
+    for selector in compiled:
+        matcher.add_selector(selector, None)
+
+    def add_selectors():
+        matcher = cssselect2.Matcher()
+        for selector in compiled:
+            matcher.add_selector(selector, None)
+
+    def match(root):
+        def match():
+            for element in root.iter_subtree():
+                matcher.match(element)
+        return match
+
+    def query_all(root, selector):
+        def query_all():
+            for _ in root.query_all(selector):
+                pass
+        return query_all
+
+    synthetic_root = cssselect2.ElementWrapper.from_html_root(document)
+    return {
+        'compile_selector_list': lambda: compile_valid(stylesheet),
+        'add_selector': add_selectors,
+        'match.shakespeare': match(shakespeare),
+        'match.content': match(content),
+        'match.synthetic': match(
+            cssselect2.ElementWrapper.from_html_root(document)),
+        'query_all.shakespeare.class': query_all(shakespeare, '.dialog'),
+        'query_all.shakespeare.descendant': query_all(
+            shakespeare, 'div div'),
+        'query_all.synthetic.type': query_all(synthetic_root, 'span'),
+        'query_all.synthetic.descendant': query_all(
+            synthetic_root, 'div p a'),
+        'query_all.synthetic.has': query_all(synthetic_root, 'p:has(> a)'),
+        'structural.nth_child': query_all(synthetic_root, ':nth-child(2n+1)'),
+        'structural.nth_last_child': query_all(
+            synthetic_root, ':nth-last-child(2)'),
+        'structural.nth_of_type': query_all(
+            synthetic_root, ':nth-of-type(2)'),
+        'structural.nth_of': query_all(
+            synthetic_root, ':nth-child(odd of .c1)'),
+        'structural.only_of_type': query_all(synthetic_root, ':only-of-type'),
+        'structural.empty': query_all(synthetic_root, ':empty'),
+    }
+
+
+def exponent(function, size, repeat, factor=4):
+    """Return the empirical exponent of the runtime growth of a function.
+
+    ``function`` is called with the input size and returns the function whose
+    runtime is measured.
+
+    """
+    times = []
+    for n in (size, size * factor):
+        timer = timeit.Timer(function(n))
+        times.append(min(timer.repeat(repeat=repeat, number=1)))
+    return log(times[1] / times[0]) / log(factor)
+
+
+def make_scalings():
+    """Return a dictionary of names, size functions and initial sizes."""
+    document = cssselect2.ElementWrapper.from_html_root(synthetic.tree(3, 5))
+    elements = list(document.iter_subtree())
+
+    def compile_rules(size):
+        rules = synthetic.stylesheet(size)
+        return lambda: [cssselect2.compile_selector_list(rule) for rule in rules]
+
+    def add_selectors(size):
+        selectors = compile_valid(synthetic.stylesheet(size))
+
+        def add_selectors():
+            matcher = cssselect2.Matcher()
+            for selector in selectors:
+                matcher.add_selector(selector, None)
+        return add_selectors
+
+    def match(size):
+        matcher = cssselect2.Matcher()
+        for selector in compile_valid(synthetic.stylesheet(size)):
+            matcher.add_selector(selector, None)
+        return lambda: [matcher.match(element) for element in elements]
+
+    return {
+        'compile_selector_list': (compile_rules, 100),
+        'add_selector': (add_selectors, 500),
+        'match': (match, 200),
+    }
+
+
+def scaling(scalings, repeat, limit):
+    """Print runtime growth exponents, return the list of too large ones."""
+    failures = []
+    for name, (function, size) in scalings.items():
+        result = exponent(function, size, repeat)
+        print(f'{name:40} {result:10.2f}', file=sys.stderr)
+        if result > limit:
+            failures.append(name)
+    return failures
+
+
+def run(benchmarks, repeat, time):
+    """Run benchmarks, return a dictionary of results."""
+    results = {}
+    for name, function in benchmarks.items():
+        timer = timeit.Timer(function)
+        number, _ = timer.autorange()
+        number = max(1, int(number * time / 0.2))
+        times = [t / number for t in timer.repeat(repeat, number)]
+        results[name] = {'seconds': min(times), 'loops': number}
+        print(f'{name:40} {min(times) * 1e3:10.3f} ms', file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print results compared to baseline, return the list of regressions."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['seconds'] / baseline[name]['seconds']
+        print(f'{name:40} {ratio:10.2f}×', file=sys.stderr)
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-o', '--output', type=Path, help='JSON file where results are written')
+    parser.add_argument(
+        '-b', '--baseline', type=Path, help='JSON file of previous results')
+    parser.add_argument(
+        '-k', '--filter', default='', help='only run benchmarks matching')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=5, help='number of runs')
+    parser.add_argument(
+        '-t', '--time', type=float, default=0.2,
+        help='approximate duration of each run, in seconds')
+    parser.add_argument(
+        '--threshold', type=float, default=1.1,
+        help='maximum ratio between results and baseline')
+    parser.add_argument(
+        '--scaling', action='store_true',
+        help='check the runtime growth with the size of stylesheets')
+    parser.add_argument(
+        '--exponent', type=float, default=1.5,
+        help='maximum runtime growth exponent with --scaling')
+    arguments = parser.parse_args(arguments)
+
+    if arguments.scaling:
+        scalings = {
+            name: scaling for name, scaling in make_scalings().items()
+            if arguments.filter in name}
+        failures = scaling(scalings, arguments.repeat, arguments.exponent)
+        if failures:
+            print(f'Too fast growth: {", ".join(failures)}', file=sys.stderr)
+            return 1
+        return 0
+
+    benchmarks = {
+        name: function for name, function in make_benchmarks().items()
+        if arguments.filter in name}
+    results = {
+        'cssselect2': cssselect2.__version__,
+        'python': platform.python_implementation(),
+        'python_version': platform.python_version(),
+        'benchmarks': run(benchmarks, arguments.repeat, arguments.time),
+    }
+    if arguments.output:
+        arguments.output.write_text(json.dumps(results, indent=2))
+    if arguments.baseline:
+        baseline = json.loads(arguments.baseline.read_text())
+        regressions = compare(
+            results['benchmarks'], baseline['benchmarks'], arguments.threshold)
+        if regressions:
+            print(f'Regressions: {", ".join(regressions)}', file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""Generate synthetic documents and stylesheets of any size.
+
+Documents are HTML ElementTree elements without namespace, to be wrapped with
+:meth:`cssselect2.ElementWrapper.from_html_root`.
+
+"""
+
+from xml.etree import ElementTree
+
+TAGS = ('div', 'p', 'span', 'a')
+
+
+def _body():
+    root = ElementTree.Element('html')
+    return root, ElementTree.SubElement(root, 'body')
+
+
+def deep(depth, tag='div'):
+    """Return a document with a chain of ``depth`` nested elements."""
+    root, parent = _body()
+    for i in range(depth):
+        parent = ElementTree.SubElement(parent, tag, {'class': f'd{i % 10}'})
+    return root
+
+
+def wide(width, tags=('p', 'span')):
+    """Return a document with ``width`` sibling elements."""
+    root, body = _body()
+    for i in range(width):
+        ElementTree.SubElement(
+            body, tags[i % len(tags)], {'class': f'w{i % 10}'})
+    return root
+
+
+def table(rows, columns):
+    """Return a document with a table of ``rows`` × ``columns`` cells."""
+    root, body = _body()
+    tbody = ElementTree.SubElement(ElementTree.SubElement(body, 'table'), 'tbody')
+    for i in range(rows):
+        row = ElementTree.SubElement(tbody, 'tr', {'id': f'r{i}'})
+        for j in range(columns):
+            ElementTree.SubElement(row, 'td', {'class': f'c{j}'}).text = 'x'
+    return root
+
+
+def classes(count, per_element, vocabulary=50):
+    """Return a document of ``count`` elements with many classes each."""
+    root, body = _body()
+    for i in range(count):
+        names = ' '.join(
+            f'k{(i + j) % vocabulary}' for j in range(per_element))
+        ElementTree.SubElement(body, 'div', {'class': names})
+    return root
+
+
+def tree(depth, width):
+    """Return a document where elements have ``width`` children."""
+    root, body = _body()
+    parents = [body]
+    for level in range(depth):
+        children = []
+        for parent in parents:
+            for i in range(width):
+                child = ElementTree.SubElement(
+                    parent, TAGS[(level + i) % len(TAGS)])
+                child.set('class', f'c{i} l{level}')
+                if i == 0:
+                    child.set('id', f'e{len(children)}-{level}')
+                if i % 3 == 0:
+                    child.set('lang', 'fr')
+                children.append(child)
+        parents = children
+    return root
+
+
+def stylesheet(rules):
+    """Return a list of ``rules`` selector strings of various kinds."""
+    patterns = (
+        '.c{i}', '#e{i}', '{tag}.k{i}', '{tag} .c{i}', '{tag} > .l{i}',
+        '.c{i} + {tag}', '.w{i} ~ {tag}', '[data-{i}]', '{tag}:nth-child({i})',
+        ':is({tag}, .d{i}):first-child', '{tag}:not(.k{i})', '.k{i}:has(> a)')
+    return [
+        patterns[i % len(patterns)].format(i=i, tag=TAGS[i % len(TAGS)])
+        for i in range(rules)]
@@ -4,13 +4,32 @@ Test suite for cssselect2.
 
 """
 
+import asyncio
+import io
+import pickle
+import warnings
 import xml.etree.ElementTree as etree  # noqa: N813
+from concurrent.futures import ThreadPoolExecutor
+from math import log
 from pathlib import Path
 
 import pytest
 
-from cssselect2 import ElementWrapper, SelectorError, compile_selector_list
+from cssselect2 import (
+    ElementWrapper,
+    LxmlElementWrapper,
+    Matcher,
+    SelectorError,
+    aio,
+    compile_selector_list,
+    explain,
+    vocabulary,
+)
+from cssselect2.budget import Budget, BudgetExceededError
+from cssselect2.metrics import Metrics, cached_property
+from cssselect2.parallel import match_documents, match_subtrees
 
+from . import synthetic
 from .w3_selectors import invalid_selectors, valid_selectors
 
 CURRENT_FOLDER = Path(__file__).parent
@@ -119,6 +138,146 @@ def test_lang():
     assert not root.matches(':lang(en)')
 
 
+def test_lang_document():
+    document = etree.fromstring('''
+        <html lang="en"><body>
+            <p id="en"/>
+            <div lang="FR"><p id="fr"/><p id="de" lang="de"/></div>
+            <p id="xml" xml:lang="it"><span id="it"/></p>
+        </body></html>
+    ''')
+    root = ElementWrapper.from_html_root(document)
+    langs = {
+        element.id: element.lang for element in root.query_all('[id]')}
+    assert langs == {'en': 'en', 'fr': 'fr', 'de': 'de', 'xml': 'it', 'it': 'it'}
+    assert [element.id for element in root.query_all('[id]:lang(fr)')] == ['fr']
+
+    # Elements added after languages have been computed
+    span = etree.SubElement(document.find('.//div'), 'span', id='new')
+    assert next(root.query_all('#new')).lang == 'fr'
+    span.set('lang', 'es')
+    assert next(root.query_all('#new')).matches(':lang(es)')
+
+
+def test_lang_mutation():
+    document = etree.fromstring('''
+        <html xmlns="http://www.w3.org/1999/xhtml">
+        <head><meta http-equiv="Content-Language" content="en"/></head>
+        <body><div lang="fr"><p/></div><p/></body></html>
+    ''')
+    root = ElementWrapper.from_xml_root(document)
+    assert [element.local_name for element in root.query_all(':lang(fr)')] == [
+        'div', 'p']
+    assert root.matches(':lang(en)')
+
+    div = root.query('div')
+    div.etree_element.set('lang', 'de')
+    # Outdated until invalidated
+    assert root.query(':lang(de)') is None
+    assert ElementWrapper.from_xml_root(document).query(':lang(de)') is not None
+    div.invalidate('lang')
+    assert div.lang == 'de'
+    assert root.query(':lang(fr)') is None
+    assert [element.local_name for element in root.query_all(':lang(de)')] == [
+        'div', 'p']
+
+    meta = root.query('meta')
+    meta.etree_element.set('content', 'es')
+    meta.invalidate('content')
+    assert [element.local_name for element in root.query_all(':lang(es)')] == [
+        'html', 'head', 'meta', 'body', 'p']
+
+
+def test_disabled_fieldset():
+    html = '{http://www.w3.org/1999/xhtml}'
+    document = etree.fromstring('''
+        <form xmlns="http://www.w3.org/1999/xhtml">
+          <fieldset disabled="">
+            <input id="a"/>
+            <legend><input id="b"/></legend>
+            <legend><input id="c"/></legend>
+            <fieldset><legend><input id="d"/></legend></fieldset>
+          </fieldset>
+          <fieldset>
+            <legend><fieldset disabled=""><input id="e"/></fieldset></legend>
+            <input id="f"/>
+          </fieldset>
+        </form>
+    ''')
+    root = ElementWrapper.from_xml_root(document)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert [element.id for element in root.query_all('input:disabled')] == [
+            'a', 'c', 'd', 'e']
+        assert [element.id for element in root.query_all('input:enabled')] == [
+            'b', 'f']
+
+        # Elements added after states have been computed
+        legend = document.find(f'.//{html}legend')
+        etree.SubElement(legend, f'{html}input', id='g')
+        new = etree.SubElement(document[0], f'{html}legend')
+        etree.SubElement(new, f'{html}input', id='h')
+        assert [element.id for element in root.query_all('input:disabled')] == [
+            'a', 'c', 'd', 'h', 'e']
+
+
+def test_disabled_fieldset_mutation():
+    html = '{http://www.w3.org/1999/xhtml}'
+    document = etree.fromstring('''
+        <form xmlns="http://www.w3.org/1999/xhtml">
+          <fieldset>
+            <legend><input id="a"/></legend>
+            <legend><input id="b"/></legend>
+            <input id="c"/>
+          </fieldset>
+        </form>
+    ''')
+    root = ElementWrapper.from_xml_root(document)
+    assert root.query('input:disabled') is None
+
+    fieldset = root.query('fieldset')
+    fieldset.etree_element.set('disabled', '')
+    # Outdated until invalidated
+    assert root.query('input:disabled') is None
+    fieldset.invalidate('disabled')
+    assert [element.id for element in root.query_all('input:disabled')] == [
+        'b', 'c']
+
+    legend = root.query('legend')
+    legend.etree_element.tag = f'{html}div'
+    legend.invalidate()
+    assert [element.id for element in root.query_all('input:disabled')] == [
+        'a', 'c']
+
+    fieldset.etree_element.remove(legend.etree_element)
+    fieldset.invalidate()
+    assert [element.id for element in root.query_all('input:disabled')] == [
+        'c']
+
+
+def test_deep_and_wide_document():
+    html = '{http://www.w3.org/1999/xhtml}'
+    root = parent = etree.Element(f'{html}html', lang='en')
+    fieldset = etree.SubElement(root, f'{html}fieldset', disabled='')
+    for _ in range(3000):
+        parent = etree.SubElement(parent, f'{html}div')
+    input = etree.SubElement(parent, f'{html}input', id='deep')
+    for _ in range(2000):
+        etree.SubElement(fieldset, f'{html}legend')
+    etree.SubElement(fieldset, f'{html}input', id='wide')
+
+    for wrapper in (ElementWrapper.from_xml_root, ElementWrapper.from_html_root):
+        deep = next(wrapper(root).query_all('#deep'))
+        assert len(deep.ancestors) == 3001
+        assert deep.matches('html > div div > input:lang(en)')
+        assert deep.matches(':enabled')
+        wide = next(wrapper(root).query_all('#wide'))
+        assert len(wide.previous_siblings) == 2000
+        assert wide.matches('legend ~ input:disabled:lang(en)')
+    input.set('lang', 'fr')
+    assert ElementWrapper.from_xml_root(root).query('#deep:lang(fr)') is not None
+
+
 @pytest.mark.parametrize('selector, result', (
     ('*', ALL_IDS),
     ('div', ['outer-div', 'li-div', 'foobar-div']),
@@ -399,3 +558,934 @@ def test_html_select(selector, result):
 ))
 def test_select_shakespeare(selector, result):
     assert sum(1 for _ in SHAKESPEARE_BODY.query_all(selector)) == result
+
+
+def test_classes():
+    root = ElementWrapper.from_xml_root(etree.fromstring(
+        '<html><p class="a  b"/><p class="b a"/><p class="a  b"/><p/></html>'))
+    first, second, third, fourth = root.iter_children()
+    assert first.classes == second.classes == {'a', 'b'}
+    assert first.classes is third.classes
+    assert first.classes is next(root.query_all('p')).classes
+    assert fourth.classes == frozenset()
+    other_root = ElementWrapper.from_xml_root(root.etree_element)
+    assert next(other_root.iter_children()).classes is not first.classes
+
+
+def test_matcher_statistics():
+    document = etree.fromstring('''
+        <html>
+          <div class="common" id="main">
+            <p class="common rare">a</p>
+            <p class="common">b</p>
+          </div>
+        </html>
+    ''')
+    root = ElementWrapper.from_html_root(document)
+    matcher = Matcher()
+    for selector in compile_selector_list('p.rare.common, div.common'):
+        matcher.add_selector(selector, None)
+    assert matcher.bucket(matcher._selectors[0][0]) == ('class', 'common')
+    assert matcher.bucket(matcher._selectors[1][0]) == ('class', 'common')
+
+    matcher.update_statistics(root)
+    assert matcher.statistics['class', 'common'] == 3
+    assert matcher.statistics['local_name', 'p'] == 2
+    matcher.reindex()
+    assert matcher.bucket(matcher._selectors[0][0]) == ('class', 'rare')
+    assert matcher.bucket(matcher._selectors[1][0]) == ('local_name', 'div')
+    assert set(matcher.class_selectors) == {'rare'}
+    assert [
+        [order for _, order, _, _ in matcher.match(element)]
+        for element in root.iter_subtree()] == [[], [2], [1], []]
+
+    matcher = Matcher(statistics={('class', 'common'): 100})
+    selector, = compile_selector_list('#main.common')
+    assert matcher.bucket(selector) == ('id', 'main')
+
+
+def test_matcher_pruned():
+    document = etree.fromstring('''
+        <html>
+          <div class="a" id="main">
+            <p title="x">a</p>
+          </div>
+        </html>
+    ''')
+    root = ElementWrapper.from_html_root(document)
+    words = vocabulary(root)
+    assert ('class', 'a') in words
+    assert ('attribute', 'title') in words
+    assert ('local_name', 'span') not in words
+
+    matcher = Matcher()
+    selectors = (
+        'p', 'span', '.a p', '.b p', '#main > p', '#other p', 'p[title]',
+        'p[lang]', ':is(span, p)', 'div:not(.b)', '*')
+    for selector in selectors:
+        matcher.add_selector(compile_selector_list(selector)[0], selector)
+    pruned = matcher.pruned(words)
+    assert [entry[-1] for _, entry in pruned._selectors] == [
+        'p', '.a p', '#main > p', 'p[title]', ':is(span, p)', 'div:not(.b)', '*']
+    for element in root.iter_subtree():
+        assert pruned.match(element) == matcher.match(element)
+
+
+def test_lazy_compilation():
+    document = etree.fromstring('<html><p class="a"/><p class="b"/></html>')
+    root = ElementWrapper.from_html_root(document)
+    matcher = Matcher()
+    selectors = compile_selector_list('.a, .c, :hover', lazy=True)
+    for selector in selectors:
+        assert selector.lazy
+        assert 'test' not in selector.__dict__
+        assert 'source' in selector.__dict__
+        matcher.add_selector(selector, None)
+    assert matcher.bucket(selectors[0]) == ('class', 'a')
+
+    assert [len(matcher.match(element)) for element in root.iter_subtree()] == [
+        0, 1, 0]
+    assert 'test' in selectors[0].__dict__
+    assert 'test' not in selectors[1].__dict__
+    assert 'test' not in selectors[2].__dict__  # Never matches, not added
+    assert selectors[2].never_matches
+    assert not selectors[1].never_matches
+    assert root.query(selectors[1]) is None
+    assert 'test' not in selectors[1].__dict__  # Only specialized tests used
+
+    # Compiled tests replace lazy ones in buckets.
+    assert matcher.class_selectors['a'][0][0] is selectors[0].test
+    assert matcher.class_selectors['c'][0][0] is not selectors[1].test
+    matcher = Matcher(in_html_document=True)
+    for selector in selectors:
+        matcher.add_selector(selector, None)
+    assert [len(matcher.match(element)) for element in root.iter_subtree()] == [
+        0, 1, 0]
+    assert matcher.class_selectors['a'][0][0] is (
+        selectors[0].specialized_test(True))
+
+    # Tests not depending on the document type are only compiled once.
+    selector, = compile_selector_list('.a')
+    assert selector.specialized_test(True) is selector.test
+    selector, = compile_selector_list(':checked')
+    assert selector.specialized_test(True) is not selector.test
+
+
+@pytest.mark.parametrize('selector', (':nth-child(foo)', ':example', ':lang(1)'))
+def test_lazy_compilation_errors(selector):
+    # Errors are raised when compiling, even when tests are compiled lazily.
+    with pytest.raises(SelectorError):
+        compile_selector_list(selector, lazy=True)
+
+
+@pytest.mark.parametrize('selector', (
+    'DIV', 'a[rel="tAg" i]', 'a[HREF*="localHOST" i]', '[NAme]', ':link',
+    ':enabled', ':disabled', ':checked', 'li:not(:checked)'))
+def test_specialized_test(selector):
+    selectors = compile_selector_list(selector)
+    for in_html_document in (False, True):
+        root = ElementWrapper._from_root(IDS_ROOT, None, in_html_document)
+        tests = [
+            selector.specialized_test(in_html_document) for selector in selectors]
+        assert selectors[0].specialized_test(in_html_document) is tests[0]
+        expected = [
+            element.id for element in root.iter_subtree()
+            if any(selector.test(element) for selector in selectors)]
+        assert [
+            element.id for element in root.iter_subtree()
+            if any(test(element) for test in tests)] == expected
+        assert [element.id for element in root.query_all(selector)] == expected
+        matcher = Matcher(in_html_document=in_html_document)
+        for selector in selectors:
+            matcher.add_selector(selector, None)
+        assert [
+            element.id for element in root.iter_subtree()
+            if matcher.match(element)] == expected
+
+
+def test_lower_attrib():
+    root = ElementWrapper.from_html_root(
+        etree.fromstring('<html><a rel="TaG" HREF="a"/></html>'))
+    link = next(root.iter_children())
+    assert link.lower_attrib == {'rel': 'tag', 'HREF': 'a'}
+    assert link.matches('a[rel=tag i]')
+    assert not link.matches('a[rel=tag]')
+
+
+def test_matcher_profile():
+    root = ElementWrapper.from_html_root(IDS_ROOT)
+    selectors = compile_selector_list('li, li:nth-child(2n), :first-child, #nope')
+    matcher = Matcher()
+    for selector in selectors:
+        matcher.add_selector(selector, None)
+    assert matcher.profiles == {}
+    assert matcher.hot_rules() == []
+    assert matcher.lower_local_name_selectors['li'][0][0] is selectors[0].test
+
+    matcher = Matcher(profile=True)
+    for selector in selectors:
+        matcher.add_selector(selector, None)
+    for element in root.iter_subtree():
+        matcher.match(element)
+    rules = matcher.hot_rules()
+    assert [rule[4] for rule in rules] == sorted(
+        (rule[4] for rule in rules), reverse=True)
+    rules = {rule[0]: rule[1:4] for rule in rules}
+    li_count = sum(1 for _ in root.query_all('li'))
+    assert rules == {
+        'li': (('local_name', 'li'), li_count, li_count),
+        'li:nth-child(2n)': (('local_name', 'li'), li_count, 3),
+        ':first-child': (('other', None), len(ALL_IDS), 11),
+        '#nope': (('id', 'nope'), 0, 0),
+    }
+    assert len(matcher.hot_rules(limit=2)) == 2
+    pruned = matcher.pruned(vocabulary(root))
+    assert pruned.profile
+    assert len(pruned.hot_rules()) == 3
+
+
+@pytest.mark.parametrize('selector, cost', (
+    ('div', 'O(1)'),
+    ('div > p + a', 'O(1)'),
+    ('div p', 'O(depth)'),
+    ('div p a', 'O(depth²)'),
+    ('div ~ p', 'O(siblings)'),
+    ('div p ~ a', 'O(depth × siblings)'),
+    (':is(div p, a ~ b)', 'O(depth × siblings)'),
+    (':not(:first-of-type)', 'O(1)'),
+    (':is(:last-of-type, :nth-last-of-type(2))', 'O(1)'),
+    (':nth-last-of-type(2 of .a)', 'O(siblings)'),
+    (':nth-child(2n of div p)', 'O(depth × siblings)'),
+    ('div:has(p)', 'O(subtree)'),
+    ('div:has(> p a)', 'O(depth × siblings)'),
+    ('div p:has(p a)', 'O(depth × subtree)'),
+))
+def test_explain_cost(selector, cost):
+    assert explain(selector)[0]['cost'] == cost
+
+
+def test_explain():
+    selector, = compile_selector_list('#a.b::before')
+    explanation, = explain(selector)
+    assert explanation == {
+        'selector': '#a.b::before',
+        'parsed_tree': selector.parsed_selector.parsed_tree,
+        'source': selector.source,
+        'bucket': ('id', 'a'),
+        'specificity': (1, 1, 1),
+        'pseudo_element': 'before',
+        'cost': 'O(1)',
+        'cost_factors': {},
+    }
+    assert [item['bucket'] for item in explain('p, ns|*', {'ns': 'x'})] == [
+        ('local_name', 'p'), ('namespace', 'x')]
+    statistics = {('local_name', 'p'): 1, ('class', 'c'): 100}
+    matcher = Matcher(statistics)
+    assert explain('p.c', matcher=matcher)[0]['bucket'] == ('local_name', 'p')
+
+
+def test_metrics():
+    root = ElementWrapper.from_html_root(IDS_ROOT)
+    matcher = Matcher()
+    for selector in compile_selector_list('li, .c, #first-li, :first-child'):
+        matcher.add_selector(selector, None)
+    elements = list(root.iter_subtree())
+    with Metrics() as metrics:
+        for element in elements:
+            matcher.match(element)
+        with Metrics() as nested:
+            list(root.query_all('li'))
+        root.matches('li')
+    counters = metrics.as_dict()
+    assert counters['tests.other'] == len(elements)
+    assert counters['tests.local_name'] == 7
+    assert counters['tests.id'] == 1
+    assert counters['computed.classes'] == len(elements)
+    assert counters['cache.class_sets.hits'] + counters[
+        'cache.class_sets.misses'] == len(elements)
+    assert 0 < counters['cache.class_sets.hit_rate'] < 1
+    assert counters['cache.specialized_test.misses'] == 1
+    assert 'wrappers' not in counters
+    # Matching elements and their ancestors
+    assert nested.as_dict()['wrappers'] == 10
+    assert nested.as_dict()['cache.element_path.hit_rate'] == 0
+    with metrics:
+        list(root.iter_subtree())
+    assert metrics.counters['wrappers'] == len(elements) - 1  # Not the root
+
+    # Hooks are only installed while a context is active.
+    assert type(vars(ElementWrapper)['classes']) is cached_property
+    assert '__wrapped__' not in vars(ElementWrapper.__init__)
+
+    # Contexts are not shared between threads.
+    def count_wrappers():
+        root = ElementWrapper.from_html_root(IDS_ROOT)
+        with Metrics() as metrics:
+            list(root.iter_subtree())
+        return metrics.counters['wrappers']
+
+    with Metrics() as metrics:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            counts = list(executor.map(lambda _: count_wrappers(), range(4)))
+    assert counts == [len(elements) - 1] * 4
+    assert 'wrappers' not in metrics.counters
+
+
+def test_budget():
+    root = ElementWrapper.from_html_root(IDS_ROOT)
+    selector = 'li li li li li, :has(li li li)'
+    expected = [element.id for element in root.query_all(selector)]
+    with Budget(steps=10_000, elements=1000, seconds=10) as budget:
+        assert [element.id for element in root.query_all(selector)] == expected
+        assert root.count(selector) == len(expected)
+    assert 0 < budget.used_steps <= 10_000
+    assert 0 < budget.used_elements <= 1000
+
+    with pytest.raises(BudgetExceededError) as exc_info:
+        with Budget(steps=50) as budget:
+            list(root.query_all(selector))
+    assert exc_info.value.budget is budget
+    assert exc_info.value.limit == 'steps'
+    assert budget.used_steps == 51
+    with pytest.raises(BudgetExceededError, match='elements'):
+        with Budget(elements=5):
+            list(root.query_all('div'))
+    with pytest.raises(BudgetExceededError, match='seconds'):
+        with Budget(seconds=0):
+            root.matches('li li')
+
+    # Nested budgets are enforced together.
+    with Budget(steps=20) as outer:
+        with pytest.raises(BudgetExceededError) as exc_info:
+            with Budget(steps=100):
+                list(root.query_all(selector))
+    assert exc_info.value.budget is outer
+
+
+def test_budget_contexts():
+    root = ElementWrapper.from_html_root(IDS_ROOT)
+    selector = ':has(li)'
+
+    # Leaving a nested context keeps the enclosing one.
+    with Budget(steps=20) as outer:
+        with Budget(steps=10_000):
+            pass
+        with pytest.raises(BudgetExceededError) as exc_info:
+            list(root.query_all(selector))
+    assert exc_info.value.budget is outer
+
+    # Entering an active context again counts the work once.
+    budget = Budget(steps=10_000)
+    matcher = Matcher(budget=budget)
+    for compiled_selector in compile_selector_list(selector):
+        matcher.add_selector(compiled_selector, None)
+    with budget:
+        assert list(root.query_all(selector))
+        used_steps = budget.used_steps
+        for element in root.iter_subtree():
+            matcher.match(element)
+        assert budget.used_steps > used_steps
+        with budget:
+            assert root.matches('html')
+        assert root.count(selector)
+    assert budget.used_steps > used_steps
+
+    # Contexts are not shared between threads.
+    expected = root.count(selector)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with Budget(steps=20):
+            futures = [executor.submit(root.count, selector) for _ in range(2)]
+            assert [future.result() for future in futures] == [expected] * 2
+
+
+@pytest.mark.parametrize('selector', ('li', 'li.c', ':has(li li li)'))
+def test_budget_etree(selector):
+    lxml_etree = pytest.importorskip('lxml.etree')
+    lxml_root = lxml_etree.parse(CURRENT_FOLDER / 'ids.html')
+    for root in (
+            ElementWrapper.from_html_root(IDS_ROOT),
+            ElementWrapper.from_html_root(lxml_root)):
+        expected = list(root.query_all_etree(selector))
+        with Budget(steps=10_000, elements=1000) as budget:
+            assert list(root.query_all_etree(selector)) == expected
+            assert root.count(selector) == len(expected)
+        assert budget.used_elements
+        with pytest.raises(BudgetExceededError, match='elements'):
+            with Budget(elements=5):
+                list(root.query_all_etree(selector))
+        with pytest.raises(BudgetExceededError, match='elements'):
+            with Budget(elements=5):
+                root.count(selector)
+
+
+def test_matcher_budget():
+    root = ElementWrapper.from_html_root(IDS_ROOT)
+    selectors = compile_selector_list('li, :has(nope), :has(li li li)')
+    matcher = Matcher(budget=Budget(steps=20))
+    for selector in selectors:
+        matcher.add_selector(selector, repr(selector.parsed_selector))
+    with pytest.raises(BudgetExceededError):
+        for element in root.iter_subtree():
+            matcher.match(element)
+
+    matcher = Matcher(budget=Budget(steps=20), disable_over_budget=True)
+    for selector in selectors:
+        matcher.add_selector(selector, repr(selector.parsed_selector))
+    elements = list(root.iter_subtree())
+    for element in elements:
+        matcher.match(element)
+    assert set(matcher.disabled_selectors) == set(selectors[1:])
+    for element in elements:
+        for *_, payload in matcher.match(element):
+            assert payload == 'li'
+    copy = pickle.loads(pickle.dumps(matcher))
+    assert len(copy.disabled_selectors) == 2
+    assert copy.match(root) == []
+    pruned = matcher.pruned(vocabulary(root))
+    assert pruned.disabled_selectors == matcher.disabled_selectors
+
+
+@pytest.mark.parametrize('selectors, attribute, old, new, scopes', (
+    ('.a', 'class', 'b', 'a b', ('self',)),
+    ('.b', 'class', 'b', 'a b', ()),
+    ('.a div, .a', 'class', None, 'a', ('self', 'descendants')),
+    ('.a ~ li', 'class', None, 'a', ('siblings',)),
+    ('.a + li, .a', 'class', None, 'a', ('self', 'siblings')),
+    ('.a ~ li li', 'class', None, 'a', ('sibling_subtrees',)),
+    ('div:is(.a li)', 'class', None, 'a', ('descendants',)),
+    ('#x, [id]', 'id', 'y', 'x', ('self',)),
+    ('[title=a]', 'title', None, 'a', ('self',)),
+    ('[title=a]', 'id', None, 'a', ()),
+    ('li:lang(fr)', 'lang', None, 'fr', ('self', 'descendants')),
+    ('li:has(.a)', 'class', None, 'a', ('document',)),
+    ('li:nth-child(odd of .a)', 'class', None, 'a', ('document',)),
+    ('li:nth-child(odd of .a)', 'class', 'b', 'b c', ()),
+    ('span', None, 'li', 'span', ('self',)),
+    ('p span', None, 'li', 'p', ('descendants',)),
+    (':first-of-type', None, 'li', 'span', ('document',)),
+    ('|*', None, 'li', '{http://www.w3.org/1999/xhtml}li', ('self',)),
+    ('|* li, p', None, 'li', '{http://www.w3.org/1999/xhtml}li', (
+        'self', 'descendants')),
+))
+def test_matcher_invalidated(selectors, attribute, old, new, scopes):
+    matcher = Matcher()
+    for selector in compile_selector_list(selectors):
+        matcher.add_selector(selector, repr(selector.parsed_selector))
+    document = etree.fromstring(
+        '<html><body><ul><li id="y" class="b"><ul><li/><li/></ul></li>'
+        '<li/><li><ul><li/></ul></li></ul><p><span/></p></body></html>')
+    root = ElementWrapper.from_html_root(document)
+    before = {
+        element: matcher.match(element) for element in root.iter_subtree()}
+
+    etree_element = document.find('.//li')
+    if attribute is None:
+        etree_element.tag = new
+    elif new is None:
+        del etree_element.attrib[attribute]
+    else:
+        etree_element.set(attribute, new)
+    elements = list(root.iter_subtree())
+    element = next(
+        element for element in elements
+        if element.etree_element is etree_element)
+    invalidated = matcher.invalidated(element, attribute, old, new)
+
+    changed = {
+        element for element in elements
+        if matcher.match(element) != before[element]}
+    assert changed <= set(invalidated)
+    scoped_elements = {
+        'self': [element],
+        'descendants': list(element.iter_subtree())[1:],
+        'siblings': list(element.iter_next_siblings()),
+        'sibling_subtrees': [
+            descendant for sibling in element.iter_next_siblings()
+            for descendant in sibling.iter_subtree()],
+        'document': elements,
+    }
+    expected = {
+        element for scope in scopes for element in scoped_elements[scope]}
+    assert invalidated == sorted(expected, key=elements.index)
+
+
+def test_matcher_invalidated_elements():
+    html = '{http://www.w3.org/1999/xhtml}'
+    matcher = Matcher()
+    for selector in compile_selector_list(':lang(fr), p + *'):
+        matcher.add_selector(selector, None)
+    document = etree.fromstring(
+        '<html xmlns="http://www.w3.org/1999/xhtml">'
+        '<head/><body><p lang="fr"><span/></p><div/></body></html>')
+    root = ElementWrapper.from_xml_root(document)
+    assert [element.local_name for element in root.query_all(':lang(fr)')] == [
+        'p', 'span']
+
+    # Namespace changes change whether the lang attribute is used.
+    p = root.query('p')
+    p.etree_element.tag = '{http://example.com/}p'
+    invalidated = matcher.invalidated(p, None, f'{html}p', p.etree_element.tag)
+    assert [element.local_name for element in invalidated] == [
+        'p', 'span', 'div']
+    assert root.query(':lang(fr)') is None
+
+    # Inserted and removed elements.
+    head = root.query('head')
+    meta = etree.SubElement(
+        head.etree_element, f'{html}meta', {
+            'http-equiv': 'content-language', 'content': 'fr'})
+    element = next(
+        element for element in root.iter_subtree()
+        if element.etree_element is meta)
+    invalidated = matcher.invalidated(element, None, None, meta.tag)
+    assert len(invalidated) == len(list(root.iter_subtree()))
+    assert [element.local_name for element in root.query_all(':lang(fr)')] == [
+        'html', 'head', 'meta', 'body', 'p', 'span', 'div']
+    head.etree_element.remove(meta)
+    invalidated = matcher.invalidated(element, None, meta.tag, None)
+    assert len(invalidated) == len(list(root.iter_subtree()))
+    assert root.query(':lang(fr)') is None
+
+
+@pytest.mark.parametrize('lazy', (True, False))
+def test_pickle(lazy):
+    document = etree.fromstring(
+        '<html><p class="a" lang="fr"/><div><p id="b"/></div></html>')
+    root = ElementWrapper.from_html_root(document)
+    matcher = Matcher()
+    selectors = compile_selector_list(
+        '.a, #b, div > p, :lang(fr), *, :nth-child(2 of p), :hover', lazy=lazy)
+    for i, selector in enumerate(selectors):
+        matcher.add_selector(selector, i)
+    matcher.update_statistics(root)
+
+    copy = pickle.loads(pickle.dumps(matcher))
+    assert copy.statistics == matcher.statistics
+    assert copy.order == matcher.order
+    assert set(copy.class_selectors) == set(matcher.class_selectors)
+    for element in root.iter_subtree():
+        assert copy.match(element) == matcher.match(element)
+
+    selector = pickle.loads(pickle.dumps(selectors[2]))
+    assert selector.source == selectors[2].source
+    assert root.query(selector).id == 'b'
+
+
+def test_match_documents(tmp_path):
+    documents = [
+        etree.fromstring(f'<html><p class="a"/><p id="p{i}"/></html>')
+        for i in range(20)]
+    path = tmp_path / 'document.xml'
+    path.write_text('<html><div><p class="a"/></div></html>')
+    documents.append(path)
+    documents.append(str(path))
+
+    results = list(match_documents(documents, ['.a', '#p3'], 2, 3))
+    assert results[:5] == [[1], [1], [1], [1, 2], [1]]
+    assert results[-2:] == [[2], [2]]
+
+    matcher = Matcher()
+    for i, selector in enumerate(compile_selector_list('.a, p, div p')):
+        matcher.add_selector(selector, lambda i=i: i)  # Unpicklable payload
+    results = list(match_documents(documents, matcher, workers=2, chunk_size=4))
+    assert len(results) == 22
+    assert [
+        (index, [order for _, order, _, _ in matches])
+        for index, matches in results[0]] == [(1, [2, 1]), (2, [2])]
+    assert [
+        (index, [order for _, order, _, _ in matches])
+        for index, matches in results[-1]] == [(2, [2, 3, 1])]
+    assert results[-1][0][1][2][3]() == 0
+
+
+@pytest.mark.parametrize('workers, depth', ((1, 1), (2, 3), (8, 10)))
+def test_match_subtrees(workers, depth):
+    matcher = Matcher()
+    selectors = compile_selector_list(
+        'div, .dialog, div + div, div ~ div > *, :nth-child(2n), body :has(a)')
+    for i, selector in enumerate(selectors):
+        matcher.add_selector(selector, i)
+    expected = [
+        (element, matcher.match(element))
+        for element in SHAKESPEARE_BODY.iter_subtree()]
+    assert list(match_subtrees(matcher, SHAKESPEARE_BODY, workers, depth)) == (
+        expected)
+
+
+def test_aio():
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(None)
+            await asyncio.sleep(0)
+
+    async def query():
+        task = asyncio.create_task(tick())
+        await asyncio.sleep(0)
+        results = [
+            element async for element in
+            aio.query_all(SHAKESPEARE_BODY, 'div.dialog', batch_size=10)]
+        matcher = Matcher()
+        matcher.add_selector(compile_selector_list('div')[0], None)
+        matches = [
+            matches async for _, matches in aio.match(
+                matcher, SHAKESPEARE_BODY, batch_size=None, time_slice=0)]
+        task.cancel()
+        return results, matches
+
+    results, matches = asyncio.run(query())
+    assert results == list(SHAKESPEARE_BODY.query_all('div.dialog'))
+    assert sum(1 for match in matches if match) == 243
+    assert len(ticks) > 2 * 246 / 10
+
+
+@pytest.mark.parametrize('selector', (
+    '*', 'div', 'div div', 'div > div', 'div + div', 'div ~ div', '.dialog',
+    'div.scene div.dialog', ':first-child', 'div:nth-child(2n+1)',
+    ':nth-of-type(3)', ':nth-child(2 of .dialog)', ':not(.dialog) > a',
+    ':is(.scene, #speech1) div', ':root', 'div:first-of-type'))
+def test_iterparse(selector):
+    path = CURRENT_FOLDER / 'shakespeare.html'
+    root = ElementWrapper.from_xml_root(etree.parse(path))
+    expected = sorted(
+        element.etree_element.get('id') or element.local_name
+        for element in root.query_all(selector))
+    with path.open('rb') as fd:
+        result = sorted(
+            element.etree_element.get('id') or element.local_name
+            for element in ElementWrapper.iterparse(fd, selector))
+    assert result == expected
+
+
+def test_iterparse_content():
+    source = io.BytesIO(
+        b'<root><a><b><c/></b><c/></a><b><c/></b><a><b/></a></root>')
+    elements = list(ElementWrapper.iterparse(source, 'a, b'))
+    assert [element.local_name for element in elements] == [
+        'b', 'a', 'b', 'b', 'a']
+    # Subtrees of yielded elements are kept
+    assert [len(element.etree_element) for element in elements] == [
+        1, 2, 1, 0, 1]
+    assert [child.local_name for child in elements[1]] == ['b', 'c']
+    assert elements[4].previous.local_name == 'b'
+    assert elements[4].previous.previous is None
+    assert elements[4].index == 2
+    assert elements[4].type_index == 1
+
+
+def test_iterparse_memory():
+    items = 10_000
+    source = io.BytesIO(
+        b'<root>' + b'<item><a/><b/></item>' * items + b'</root>')
+    elements = []
+    for element in ElementWrapper.iterparse(source, 'item:nth-of-type(1000n)'):
+        assert element.type_index == element.index
+        # Closed siblings are removed from their parent
+        assert element.parent.etree_element[0] is element.etree_element
+        # Unreachable siblings are forgotten
+        assert element.previous.previous is None
+        elements.append(element)
+    assert len(elements) == items // 1000
+    assert not any(
+        element.etree_element in element.parent.etree_element
+        for element in elements)
+
+
+@pytest.mark.parametrize('selector', (
+    ':last-child', 'a:has(b)', 'a :empty', ':not(:only-child)',
+    ':nth-last-child(2)', ':nth-child(2 of :last-of-type)',
+    ':is(a, :nth-last-of-type(2))'))
+def test_iterparse_invalid(selector):
+    with pytest.raises(SelectorError):
+        next(ElementWrapper.iterparse(io.BytesIO(b'<root/>'), selector))
+
+
+@pytest.mark.parametrize('selector, wrappers', (
+    ('*', False),
+    ('div', False),
+    ('DIV', False),
+    ('|div', False),
+    ('html|div', False),
+    ('div.a, #first-li', False),
+    ('a[rel="tAg" i]', False),
+    ('a[href^="http"], [NAme], div[foobar~="bc"], [lang|="En"]', False),
+    ('div div', True),
+    ('li:nth-child(2n)', True),
+    (':not(li)', True),
+))
+def test_query_all_etree(selector, wrappers):
+    namespaces = {'html': 'http://www.w3.org/1999/xhtml'}
+    for root in (
+            ElementWrapper.from_xml_root(IDS_ROOT),
+            ElementWrapper.from_html_root(IDS_ROOT)):
+        selectors = compile_selector_list(selector, namespaces)
+        tests = [
+            selector.etree_test(root.in_html_document) for selector in selectors]
+        assert (None in tests) == wrappers
+        expected = [element.etree_element for element in root.query_all(*selectors)]
+        assert list(root.query_all_etree(*selectors)) == expected
+        assert root.count(*selectors) == len(expected)
+    assert SHAKESPEARE_BODY.count('div.dialog') == 51
+
+
+@pytest.mark.parametrize('selector, path', (
+    ('div', './/{*}div'),
+    ('DIV', './/{*}DIV'),
+    ('html|div', './/{http://www.w3.org/1999/xhtml}div'),
+    ('|div', './/div'),
+    ('#first', ".//*[@id='first']"),
+    ('li[id]', './/{*}li[@id]'),
+    ('[href="#"]', ".//*[@href='#']"),
+    ("[id='na\"me-an\\'chor']", None),
+    ('html|*', None),
+    ('div.dialog', None),
+    ('a[rel="tag" i]', None),
+    ('div li', None),
+))
+def test_element_path(selector, path):
+    namespaces = {'html': 'http://www.w3.org/1999/xhtml'}
+    xml_root = ElementWrapper.from_xml_root(IDS_ROOT)
+    html_root = ElementWrapper.from_html_root(IDS_ROOT)
+    for root in (xml_root, html_root, next(xml_root.query_all('ol'))):
+        selectors = compile_selector_list(selector, namespaces)
+        if root is xml_root:
+            assert selectors[0].element_path(False) == path
+        expected = [
+            element.etree_element for element in root.iter_subtree()
+            if any(selector.test(element) for selector in selectors)]
+        result = list(root.query_all(*selectors))
+        assert [element.etree_element for element in result] == expected
+        for element in result[1:]:
+            assert element.index == element.parent.etree_children.index(
+                element.etree_element)
+        assert list(root.query_all_etree(*selectors)) == expected
+    assert selectors[0].element_path(True) == (path and path.replace('DIV', 'div'))
+
+
+def test_element_path_multiple():
+    root = ElementWrapper.from_html_root(IDS_ROOT)
+    expected = [
+        element.etree_element for element in root.iter_subtree()
+        if element.local_name in ('li', 'ol') or element.id == 'first']
+    result = root.query_all('li', '#first', 'ol')
+    assert [element.etree_element for element in result] == expected
+
+
+@pytest.mark.parametrize('selector, translated', (
+    ('*', True),
+    ('div', True),
+    ('DIV', True),
+    ('div div, li > div', True),
+    ('li ~ li.c, div + div', True),
+    ('a[rel="tag"], a[href^="http"], a[href$="org"], a[href*="local"]', True),
+    ('[foobar~="bc"], [lang|="En"], [NAme]', True),
+    ('[href$=""], [href*=""], [foobar~="ab bc"]', True),
+    ("[id='na\"me-an\\'chor']", True),
+    ('a[rel="tAg" i]', False),
+    (':root, :first-child, :last-child, :only-child, :empty', True),
+    ('li:nth-child(2n+1), li:nth-last-child(even), li:nth-child(-n+2)', True),
+    ('p > input:nth-child(2n of p input[type=checkbox])', True),
+    (':nth-last-child(1 of [type=checkbox])', True),
+    ('ol:nth-of-type(2)', False),
+    ('a:not([href]), li:not(:nth-child(odd), #second-li), :not(*)', True),
+    (':is(div, fieldset), :where(.c) *', True),
+    ('p:has(> fieldset), ol:has(+ p, ~ ol), ol:has( > :not( li ))', True),
+    (':link, :checked, :hover', True),
+    (':local-link', False),
+    (':enabled', False),
+    (':lang(en)', False),
+))
+def test_xpath(selector, translated):
+    lxml_etree = pytest.importorskip('lxml.etree')
+    lxml_root = lxml_etree.parse(CURRENT_FOLDER / 'ids.html')
+    for in_html_document in (False, True):
+        selectors = compile_selector_list(selector)
+        assert translated == all(
+            selector.xpath(in_html_document) is not None
+            for selector in selectors)
+        root = ElementWrapper._from_root(IDS_ROOT, None, in_html_document)
+        expected = [element.id for element in root.query_all(selector)]
+        root = ElementWrapper._from_root(lxml_root, None, in_html_document)
+        elements = list(root.query_all(selector))
+        assert [element.id for element in elements] == expected
+        assert [
+            element.etree_element for element in elements] == list(
+            root.query_all_etree(selector))
+        assert root.count(selector) == len(expected)
+        for element in elements:
+            assert element.matches(*selectors)
+            if element.index:
+                siblings = list(element.parent.iter_children())
+                assert element.previous == siblings[element.index - 1]
+            else:
+                assert element.previous is None
+
+
+@pytest.mark.parametrize('selector', (
+    '*', 'div div', 'li ~ li.c', 'div + div', 'a ~ a', ':lang(en)', ':enabled',
+    ':disabled', 'ol:nth-of-type(2)', 'li:nth-last-of-type(2)',
+    ':nth-last-child(1 of [type=checkbox])', 'ol:has(~ ol)', 'ol:has(+ p)',
+    'p *:only-of-type', ':local-link', 'a[rel="tAg" i]', ':root'))
+def test_lxml_element_wrapper(selector):
+    lxml_etree = pytest.importorskip('lxml.etree')
+    lxml_root = lxml_etree.parse(CURRENT_FOLDER / 'ids.html')
+    root = LxmlElementWrapper.from_html_root(lxml_root)
+    expected = [
+        element.id for element in
+        ElementWrapper.from_html_root(IDS_ROOT).query_all(selector)]
+    assert [element.id for element in root.query_all(selector)] == expected
+    assert [
+        element.id for element in root.iter_subtree()
+        if element.matches(selector)] == expected
+    for etree_element in root.query_all_etree('*'):
+        element = root._wrap(etree_element)
+        assert element.matches(selector) == (element.id in expected)
+        assert isinstance(element, LxmlElementWrapper)
+        if element.parent is not None:
+            assert element.etree_siblings[element.index] == etree_element
+            assert list(element.parent.iter_children())[element.index] == element
+            assert list(element.previous_siblings) == list(
+                reversed(list(element.parent.iter_children())[:element.index]))
+            assert list(element.iter_next_siblings()) == list(
+                element.parent.iter_children())[element.index + 1:]
+
+
+@pytest.mark.parametrize('selector, supported', (
+    ('*', True),
+    ('div, DIV', True),
+    ('div div, li > div, li ~ li.c, div + div, a ~ a', True),
+    ('a[rel="tag"], a[href^="http"], a[href$="org"], a[href*="local"]', True),
+    ('[foobar~="bc"], [lang|="En"], [NAme], a[rel="tAg" i]', True),
+    ('[href$=""], [href*=""], [foobar~="ab bc"], #first-li', True),
+    (':root, :first-child, :last-child, :only-child, :empty', True),
+    ('li:nth-child(2n+1), li:nth-last-child(even), li:nth-child(-n+2)', True),
+    ('p > input:nth-child(2n of p input[type=checkbox])', True),
+    (':nth-last-child(1 of [type=checkbox])', True),
+    ('ol:nth-of-type(2), li:nth-last-of-type(2), p *:only-of-type', True),
+    (':first-of-type, :last-of-type, :nth-of-type(1 of .e)', True),
+    ('a:not([href]), li:not(:nth-child(odd), #second-li), :not(*)', True),
+    (':is(div, fieldset), :where(.c) *, :hover', True),
+    ('p:has(> fieldset), ol:has(+ p, ~ ol), ol:has( > :not( li ))', True),
+    ('p:has(input), html:has(#nofollow-anchor)', True),
+    ('::before, p::after', True),
+    (':link', False),
+    (':enabled', False),
+    (':lang(en)', False),
+    ('[*|lang]', False),
+))
+def test_columnar(selector, supported):
+    columnar = pytest.importorskip('cssselect2.columnar')
+    for in_html_document in (False, True):
+        document = columnar.ColumnarDocument(IDS_ROOT, in_html_document)
+        if not supported:
+            with pytest.raises(SelectorError):
+                document.mask(selector)
+            continue
+        root = ElementWrapper._from_root(IDS_ROOT, None, in_html_document)
+        expected = list(root.query_all_etree(selector))
+        assert document.query_all(selector) == expected
+        assert document.count(selector) == len(expected)
+        selectors = compile_selector_list(selector)
+        assert document.query_all(*selectors) == expected
+
+
+def test_columnar_valid_selectors():
+    columnar = pytest.importorskip('cssselect2.columnar')
+    document = columnar.ColumnarDocument(TEST_DOCUMENT)
+    for test in valid_selectors:
+        if not isinstance(test, dict):
+            continue  # Failing test
+        try:
+            elements = document.query_all(test['selector'])
+        except SelectorError:
+            continue
+        assert [element.get('id') for element in elements] == test['expect']
+
+
+def test_columnar_structure():
+    columnar = pytest.importorskip('cssselect2.columnar')
+    root = ElementWrapper.from_html_root(synthetic.tree(3, 3))
+    document = columnar.ColumnarDocument(root.etree_element)
+    elements = list(root.iter_subtree())
+    assert document.ends.tolist() == [
+        index + sum(1 for _ in element.iter_subtree())
+        for index, element in enumerate(elements)]
+
+    # Attribute values are stored once, whatever their length.
+    body = etree.Element('body')
+    etree.SubElement(body, 'p', title='x' * 100_000)
+    for _ in range(100):
+        etree.SubElement(body, 'p', title='y')
+    document = columnar.ColumnarDocument(body)
+    assert document.count('[title=y]') == 100
+    assert document.count('[title^=x]') == 1
+    assert document.count('[title="Y" i]') == 100
+    assert sum(array.nbytes for array in document._attributes['title'][:2]) < 10_000
+
+
+def _exponent(function, size, factor=4):
+    """Return the empirical exponent of the growth of the work of a function.
+
+    ``function`` is called with the input size and returns the function whose
+    work is measured, as the number of steps and elements counted by a budget.
+    Unlike timings, these counts don’t depend on the machine running tests.
+
+    """
+    counts = []
+    for n in (size, size * factor):
+        run = function(n)
+        with Budget() as budget:
+            run()
+        counts.append(budget.used_steps + budget.used_elements)
+    return log(counts[1] / counts[0]) / log(factor)
+
+
+def _query(document, selector):
+    def make(size):
+        root = ElementWrapper.from_html_root(document(size))
+        return lambda: sum(1 for _ in root.query_all(selector))
+    return make
+
+
+@pytest.mark.parametrize('document, selector, size, bound', (
+    (synthetic.deep, 'div', 100, 1),
+    (synthetic.deep, '.d3', 100, 1),
+    (synthetic.deep, 'div > div', 100, 1),
+    (synthetic.deep, 'div div', 100, 1),
+    (synthetic.deep, 'span div', 100, 2),
+    (synthetic.deep, ':has(span)', 40, 2),
+    (synthetic.wide, 'p', 100, 1),
+    (synthetic.wide, ':nth-child(2n+1)', 100, 1),
+    (synthetic.wide, ':nth-last-child(2)', 100, 1),
+    (synthetic.wide, ':first-of-type', 100, 1),
+    (synthetic.wide, ':last-of-type', 100, 1),
+    (synthetic.wide, ':only-of-type', 100, 1),
+    (synthetic.wide, ':nth-of-type(2)', 100, 1),
+    (synthetic.wide, ':nth-last-of-type(2)', 100, 1),
+    (synthetic.wide, 'p + span', 100, 1),
+    (synthetic.wide, 'span ~ p', 100, 1),
+    (synthetic.wide, 'p:has(+ span)', 100, 1),
+    (synthetic.wide, 'p:has(~ div)', 60, 2),
+    (lambda size: synthetic.table(size, 10), 'td:nth-child(2)', 20, 1),
+    (lambda size: synthetic.table(size, 10), 'tr:nth-child(odd) .c1', 20, 1),
+    (lambda size: synthetic.table(size, 10), 'td:empty', 20, 1),
+    (lambda size: synthetic.classes(size, 10), '.k3', 100, 1),
+))
+def test_query_scaling(document, selector, size, bound):
+    # Allow lower-order terms, but catch one more degree of complexity.
+    assert _exponent(_query(document, selector), size) < bound + 0.5
+
+
+def test_matcher_scaling():
+    elements = list(
+        ElementWrapper.from_html_root(synthetic.tree(3, 5)).iter_subtree())
+
+    def match(size):
+        matcher = Matcher(budget=Budget())
+        for rule in synthetic.stylesheet(size):
+            for selector in compile_selector_list(rule):
+                matcher.add_selector(selector, None)
+        return lambda: [matcher.match(element) for element in elements]
+
+    assert _exponent(match, 200) < 1.5